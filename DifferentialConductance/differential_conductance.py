@@ -1,46 +1,34 @@
-import csv
+import sys
 import time
-import datetime
+import asyncio
+import pathlib
 
 import pyvisa
 
 import numpy as np
 
+try:
+    import nidaqmx
+except ImportError:
+    # Only needed for the DAQ lock-in
+    nidaqmx = None
 
-class DataWriter:
-    """
-    This class provides a way to store two data-files with the same data. One
-    file is named with a unique name that ensure that no data is lost. The
-    other file is always called `data.csv`
-    """
-
-    def __init__(self):
-        now = datetime.datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
-        filename = 'data_' + now + '.csv'
-        self.liveplot = open('data.csv', 'w', newline='\n')
-        self.datafile = open(filename, 'w', newline='\n')
-        self.livewriter = csv.writer(self.liveplot, delimiter=';')
-        self.datawriter = csv.writer(self.datafile, delimiter=';')
-
-    def write_line(self, **kwargs):
-        self.livewriter.writerow(kwargs.values())
-        self.datawriter.writerow(kwargs.values())
-        self.liveplot.flush()
-        self.datafile.flush()
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from common import tracing  # noqa: E402
+from common.async_instruments import AsyncInstrument, ordered  # noqa: E402
+from common.data_writer import DataWriter  # noqa: E402
+from common.instrument_registry import get_instrument  # noqa: E402
+from common.scpi_cache import ScpiCache  # noqa: E402
 
 
 class Agilent34401a:
-    def __init__(self):
-        rm = pyvisa.ResourceManager()
-        # print(rm.list_resources())
-        self.instr = rm.open_resource('ASRL1::INSTR')
-        self.instr.timeout = 2000  # ms
-        self.instr.write_termination = '\n'
-        self.instr.read_termination = '\n'
-        self.instr.baud_rate = 9600
-        self.instr.data_bits = 8
-        self.instr.stop_bits = pyvisa.constants.StopBits.two
-        self.instr.parity = pyvisa.constants.Parity.none
+    # Size of the reading memory
+    MAX_READINGS = 512
+
+    def __init__(self, cache=True):
+        instr = get_instrument('ASRL1::INSTR', configure=self._configure)
+        # Redundant settings are not sent, see ScpiCache
+        self.instr = ScpiCache(instr, enabled=cache)
         self.instr.write('*RST')
         time.sleep(0.5)
         print('SET SYSTEM REMOTE')
@@ -53,17 +41,28 @@ class Agilent34401a:
         # cmd = 'SENSe:VOLTage:DC:NPLCycles?'
         # print(self.instr.query(cmd))
 
+    @staticmethod
+    def _configure(instr):
+        instr.timeout = 2000  # ms
+        instr.write_termination = '\n'
+        instr.read_termination = '\n'
+        instr.baud_rate = 9600
+        instr.data_bits = 8
+        instr.stop_bits = pyvisa.constants.StopBits.two
+        instr.parity = pyvisa.constants.Parity.none
+
     def set_voltage_mode(self, dc=True):
-        if dc:
-            cmd = 'CONF:VOLT:DC 0, 1e-6'
-            self.instr.write(cmd)
-            cmd = 'VOLTAGE:DC:RANGE:AUTO ON'
-            self.instr.write(cmd)
-        else:  # AC
-            cmd = 'CONF:VOLT:AC 0, 1e-6'
-            self.instr.write(cmd)
-            cmd = 'VOLTAGE:AC:RANGE:AUTO ON'
-            self.instr.write(cmd)
+        with self.instr.batch():
+            if dc:
+                cmd = 'CONF:VOLT:DC 0, 1e-6'
+                self.instr.write(cmd)
+                cmd = 'VOLTAGE:DC:RANGE:AUTO ON'
+                self.instr.write(cmd)
+            else:  # AC
+                cmd = 'CONF:VOLT:AC 0, 1e-6'
+                self.instr.write(cmd)
+                cmd = 'VOLTAGE:AC:RANGE:AUTO ON'
+                self.instr.write(cmd)
         # self.instr.write(cmd)
 
         'VOLTage:DC:RANGe:AUTO ON'
@@ -76,14 +75,215 @@ class Agilent34401a:
         value = float(data)
         return value
 
+    def reading_time(self, dc=True):
+        """
+        Approximate duration of a single reading in the current mode.
+        Auto-zero doubles the integration time, 50Hz mains is assumed.
+        """
+        if not dc:
+            # The AC-filter settles slowly, the reading itself is fast
+            return 0.1
+        nplc = float(self.instr.query('VOLTAGE:DC:NPLC?'))
+        return 2 * nplc / 50
+
+    def arm_burst(self, samples):
+        """
+        Arm the DMM to take one reading on each of the next `samples`
+        external triggers. Readings are kept in the instrument until
+        fetch_burst() is called.
+        """
+        if samples > self.MAX_READINGS:
+            raise ValueError('At most {} readings'.format(self.MAX_READINGS))
+        cmd = 'SAMP:COUNT 1;:TRIG:COUNT {};:TRIG:SOUR EXT'.format(samples)
+        self.instr.write(cmd)
+        self.instr.write('INIT')
+        # The writes return before the commands have been transferred, at
+        # 11 bits per character and 9600 baud. Triggers before that are lost
+        time.sleep((len(cmd) + len('INIT') + 2) * 11 / 9600)
+
+    def fetch_burst(self, samples):
+        """
+        Transfer all readings of a burst in one go. Returns a numpy array,
+        raises RuntimeError if the meter did not return `samples` readings.
+        """
+        # Each reading is about 16 characters of 11 bits at 9600 baud
+        timeout = self.instr.timeout
+        self.instr.timeout = timeout + 1000 * samples * 16 * 11 / 9600
+        try:
+            data = self.instr.query('FETCH?')
+        finally:
+            self.instr.timeout = timeout
+        # Back to a single, immediate reading per READ?
+        self.instr.write('TRIG:COUNT 1;:TRIG:SOUR IMM')
+        values = np.fromstring(data, sep=',')
+        if len(values) != samples:
+            msg = 'Expected {} readings from FETCH?, got {}'
+            raise RuntimeError(msg.format(samples, len(values)))
+        return values
+
+
+class DaqLockIn:
+    """
+    Software lock-in on the shunt voltage sampled by the DAQ, as an
+    alternative to the AC-mode of the DMM. The shunt is demodulated at
+    the frequency of the AWG (253.154Hz) over a whole number of periods.
+    The DAQ is not synchronised with the AWG, so the phase is relative
+    to the start of the acquisition unless a reference channel (eg. the
+    AWG output) is given; then the phase is relative to the reference.
+    """
+
+    def __init__(
+        self,
+        channel='Dev1/ai0',
+        reference=None,
+        freq=253.154,
+        periods=10,
+        settle_periods=2,
+        sample_rate=50e3,
+        min_val=-10,
+        max_val=10,
+    ):
+        if nidaqmx is None:
+            raise RuntimeError('nidaqmx is needed for the DAQ lock-in')
+        self.freq = freq
+        self.periods = periods
+        self.settle_periods = settle_periods
+        self.sample_rate = sample_rate
+        self.task = nidaqmx.Task()
+        self.channels = [channel] if reference is None else [channel, reference]
+        for name in self.channels:
+            self.task.ai_channels.add_ai_voltage_chan(
+                name,
+                terminal_config=nidaqmx.constants.TerminalConfiguration.DIFF,
+                min_val=min_val,
+                max_val=max_val,
+            )
+
+    def read(self):
+        """
+        Wait settle_periods and read `periods` periods of the reference
+        frequency from all channels. Returns an array (channels, samples).
+        """
+        samples = int(round(self.periods * self.sample_rate / self.freq))
+        time.sleep(self.settle_periods / self.freq)
+        self.task.timing.cfg_samp_clk_timing(
+            rate=self.sample_rate,
+            sample_mode=nidaqmx.constants.AcquisitionType.FINITE,
+            samps_per_chan=samples,
+        )
+        with tracing.span('daq', 'lock-in {} samples'.format(samples)) as span:
+            data = self.task.read(
+                number_of_samples_per_channel=samples,
+                timeout=10 + samples / self.sample_rate,
+            )
+            self.task.stop()
+            span['bytes_in'] = 8 * samples * len(self.channels)
+        return np.array(data).reshape(len(self.channels), samples)
+
+    def demodulate(self, data):
+        """
+        Mean, in-phase and quadrature component (as peak values) of each
+        row of data.
+        """
+        t = np.arange(data.shape[-1]) / self.sample_rate
+        mean = data.mean(axis=-1)
+        signal = data - mean[..., np.newaxis]
+        in_phase = 2 * np.mean(signal * np.sin(2 * np.pi * self.freq * t), axis=-1)
+        quadrature = 2 * np.mean(signal * np.cos(2 * np.pi * self.freq * t), axis=-1)
+        return mean, in_phase, quadrature
+
+    def measure(self):
+        """
+        Returns the mean, in-phase and quadrature component of the shunt
+        voltage, the latter two as peak values.
+        """
+        mean, in_phase, quadrature = self.demodulate(self.read())
+        if len(self.channels) == 1:
+            return mean[0], in_phase[0], quadrature[0]
+        # Rotate the shunt signal by the phase of the reference
+        signal = complex(in_phase[0], quadrature[0])
+        reference = complex(in_phase[1], quadrature[1])
+        signal = signal * abs(reference) / reference
+        return mean[0], signal.real, signal.imag
+
+    def close(self):
+        self.task.close()
+
+
+class AdaptiveStepper:
+    """
+    Chooses the next bias step from the part of the curve measured so
+    far, aiming for the same change of current, di_target, in every
+    step: the step is di_target / |dI/dV|, and where the curve bends it
+    is further limited to sqrt(2 * di_target / |d2I/dV2|), ie. the step
+    over which a straight line is off by di_target. Steps are kept
+    between min_step and max_step. With max_points the steps are made
+    long enough to reach v_to within that number of points.
+    """
+
+    def __init__(self, min_step, max_step, di_target, max_points=None):
+        self.min_step = min_step
+        self.max_step = max_step
+        self.di_target = di_target
+        self.max_points = max_points
+        self.reset()
+
+    def reset(self):
+        self.v_dut = []
+        self.current = []
+        self.di_dv = []
+
+    def finished(self):
+        if self.max_points is None:
+            return False
+        return len(self.v_dut) >= self.max_points
+
+    def _slope(self, x, y):
+        if len(x) < 2 or x[-1] == x[-2]:
+            return None
+        return (y[-1] - y[-2]) / (x[-1] - x[-2])
+
+    def next_step(self, v_dut, current, v_to, di_dv=None):
+        """
+        Add a measured point and return the step to the next bias. di_dv
+        is used if measured (AC and delta), otherwise it is estimated
+        from the last two points.
+        """
+        self.v_dut.append(v_dut)
+        self.current.append(current)
+        if di_dv is None:
+            di_dv = self._slope(self.v_dut, self.current)
+        if di_dv is not None:
+            self.di_dv.append(di_dv)
+
+        step = self.max_step
+        if di_dv:
+            step = min(step, self.di_target / abs(di_dv))
+        if len(self.di_dv) >= 2:
+            curvature = self._slope(self.v_dut[-1 * len(self.di_dv) :], self.di_dv)
+            if curvature:
+                step = min(step, (2 * self.di_target / abs(curvature)) ** 0.5)
+        if self.max_points is not None:
+            points_left = max(self.max_points - len(self.v_dut), 1)
+            step = max(step, (v_to - v_dut) / points_left)
+        return min(max(step, self.min_step), self.max_step)
+
 
 class DCMeasurement:
     """
-    Implements several modes of Differential Conductance Measurements
+    Implements several modes of Differential Conductance Measurements.
+    dc_settle and ac_settle are optional SettleDetectors, used instead
+    of the fixed waits before DC and AC readings that are longer than a
+    reading. A detector needs several readings, so the short waits in
+    iv_curve, delta_sweep and the two-pass ladder are kept. lockin is an
+    optional DaqLockIn for ac_sweep(detector='daq'). With cache, redundant AWG
+    commands are not sent, see ScpiCache.
     """
 
-    def __init__(self, dmm, r_shunt):
-        self.writer = DataWriter()
+    def __init__(
+        self, dmm, r_shunt, dc_settle=None, ac_settle=None, lockin=None, cache=True
+    ):
+        self.writer = DataWriter('data.csv')
 
         self.writer.write_line(
             time='Time',
@@ -93,20 +293,23 @@ class DCMeasurement:
             v_dut='V_dut',
             di_dv='dI_dV',
             di='dI',
+            phase='Phase',
         )
 
         self.t_start = time.time()
         self.r_shunt = r_shunt
         self.dmm = dmm
-        rm = pyvisa.ResourceManager()
-        for visaRsrcAddr in rm.list_resources():
-            print(visaRsrcAddr)
-            if "USB0" in visaRsrcAddr:
-                break
-        self.awg = rm.open_resource(visaRsrcAddr)
+        self.dc_settle = dc_settle
+        self.ac_settle = ac_settle
+        self.lockin = lockin
+        self.awg = ScpiCache(get_instrument(match='USB0'), enabled=cache)
         # self._init_channel(1)
         self._init_channel(2)
-        time.sleep(2)  # Allow instruments to settle
+        # Allow instruments to settle
+        if self.dc_settle is None:
+            time.sleep(2)
+        else:
+            self.dc_settle.wait(self._read_shunt)
 
     def _auto_range(self, channel, state):
         if state:
@@ -124,21 +327,24 @@ class DCMeasurement:
         print(self.awg.query('*IDN?'))
 
         time.sleep(0.5)
-        self._auto_range(channel, True)
         if dc:
-            cmd = 'SOURCE{}:FUNCTION DC'.format(channel)
-            self.awg.write(cmd)
-            cmd = 'SOURCE{}:APPLY:DC DEF, DEF, 1'.format(channel)
-            self.awg.write(cmd)
-            self._auto_range(channel, False)
-            self.set_dc_voltage(0, channel=channel)
+            with self.awg.batch():
+                self._auto_range(channel, True)
+                cmd = 'SOURCE{}:FUNCTION DC'.format(channel)
+                self.awg.write(cmd)
+                cmd = 'SOURCE{}:APPLY:DC DEF, DEF, 1'.format(channel)
+                self.awg.write(cmd)
+                self._auto_range(channel, False)
+                self.set_dc_voltage(0, channel=channel)
         else:  # This is an AC-measurement
-            cmd = 'SOURCE{}:FUNCTION SINUSOID'.format(channel)
-            self.awg.write(cmd)
-            cmd = 'SOURCE{}:VOLTAGE 1'.format(channel)
-            self.awg.write(cmd)
-            cmd = 'SOURCE{}:FREQUENCY 253.154'.format(channel)
-            self.awg.write(cmd)
+            with self.awg.batch():
+                self._auto_range(channel, True)
+                cmd = 'SOURCE{}:FUNCTION SINUSOID'.format(channel)
+                self.awg.write(cmd)
+                cmd = 'SOURCE{}:VOLTAGE 1'.format(channel)
+                self.awg.write(cmd)
+                cmd = 'SOURCE{}:FREQUENCY 253.154'.format(channel)
+                self.awg.write(cmd)
             time.sleep(5)
             self.set_dc_voltage(1)
             # self._auto_range(channel, False)
@@ -166,38 +372,290 @@ class DCMeasurement:
         cmd = 'SOURCE{}:VOLTAGE {:.6f}'.format(channel, voltage)
         self.awg.write(cmd)
 
+    def _read_shunt(self):
+        self.dmm.prepare_read()
+        self.trig_external()
+        return self.dmm.read_after_trigger()
+
+    def _settled_read(self, detector, wait):
+        """
+        Read the shunt voltage once the reading has settled according to
+        detector, or after a fixed wait if no detector is given.
+        """
+        if detector is None:
+            time.sleep(wait)
+            return self._read_shunt()
+        return detector.wait(self._read_shunt)
+
+    @staticmethod
+    def _step(stepper, v_step, v_dut, current, v_to, di_dv=None):
+        if stepper is None:
+            return v_step
+        return stepper.next_step(v_dut, current, v_to, di_dv)
+
+    @staticmethod
+    def _budget_used(stepper):
+        return stepper is not None and stepper.finished()
+
+    def _lockin_read(self):
+        """
+        DC and peak-peak AC shunt voltage from the DAQ lock-in, the same
+        quantities as the DMM gives in DC and (scaled) AC-mode, and the
+        phase of the AC part in radians. With a reference channel only the
+        part in phase with the reference is used and the phase is relative
+        to the reference, otherwise the amplitude is used and the phase is
+        relative to the start of the acquisition.
+        """
+        v_shunt, in_phase, quadrature = self.lockin.measure()
+        phase = np.arctan2(quadrature, in_phase)
+        if len(self.lockin.channels) > 1:
+            return v_shunt, 2 * in_phase, phase
+        return v_shunt, 2 * np.hypot(in_phase, quadrature), phase
+
     def read_at_voltage(self, voltage):
         """
         Used by the two dc-measurements,
         similar but not identical code exists in the AC-mode code.
         """
         self.set_dc_voltage(voltage)
+        # Shorter than a reading, not worth the readings of a detector
         time.sleep(0.002)
-        self.dmm.prepare_read()
-        self.trig_external()
-        v_shunt = self.dmm.read_after_trigger()
+        v_shunt = self._read_shunt()
         current = v_shunt / self.r_shunt
         v_output = 50 * current  # Signal source has 50ohm output
         v_dut = voltage - v_shunt - v_output
         return current, v_dut, v_shunt
 
-    def iv_curve(self, v_from, v_to, v_step):
+    def read_voltages(self, voltages):
+        """
+        read_at_voltage for each of a list of voltages, returns arrays of
+        current, v_dut and v_shunt like read_burst.
+        """
+        readings = [self.read_at_voltage(voltage) for voltage in voltages]
+        current, v_dut, v_shunt = (np.array(x) for x in zip(*readings))
+        return current, v_dut, v_shunt
+
+    def read_burst(self, voltages, settle=0.002, dwell=None):
+        """
+        Buffered version of read_at_voltage for a list of voltages: one DMM
+        reading is triggered at each voltage and the readings are fetched
+        in a single transfer per segment of at most MAX_READINGS.
+        dwell is the time allowed for each reading, by default the
+        reading time reported by the DMM.
+        Returns arrays of current, v_dut and v_shunt.
+        """
+        voltages = np.asarray(voltages)
+        if len(voltages) == 0:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        if dwell is None:
+            dwell = self.dmm.reading_time()
+
+        segments = []
+        for start in range(0, len(voltages), self.dmm.MAX_READINGS):
+            segment = voltages[start : start + self.dmm.MAX_READINGS]
+            self.dmm.arm_burst(len(segment))
+            for voltage in segment:
+                self.set_dc_voltage(voltage)
+                time.sleep(settle)
+                self.trig_external()
+                time.sleep(dwell)
+            segments.append(self.dmm.fetch_burst(len(segment)))
+        v_shunt = np.concatenate(segments)
+
+        current = v_shunt / self.r_shunt
+        v_output = 50 * current  # Signal source has 50ohm output
+        v_dut = voltages - v_shunt - v_output
+        return current, v_dut, v_shunt
+
+    def _async_instruments(self):
+        """
+        AsyncInstrument wrappers of the AWG and the DMM, one pair per
+        event loop (the locks belong to a loop).
         """
-        Simulated current-step iv-curve. Total voltage is in
-        each step increased by v_step + previous v_shunt in an
-        attempt to make v_dut spacing approximately constant
+        loop = asyncio.get_running_loop()
+        if getattr(self, '_async_loop', None) is not loop:
+            self._async_loop = loop
+            self._async = (
+                AsyncInstrument(self.awg, 'awg'),
+                AsyncInstrument(self.dmm, 'dmm'),
+            )
+        return self._async
+
+    async def _read_shunt_async(self):
+        awg, dmm = self._async_instruments()
+        # The reading must be prepared, triggered and read in this order
+        async with ordered(awg, dmm):
+            await dmm.call('prepare_read')
+            await awg.run(self.trig_external)
+            return await dmm.call('read_after_trigger')
+
+    async def read_burst_async(self, voltages, settle=0.002, dwell=None):
         """
+        read_burst with the DMM and the AWG used concurrently: the
+        readings of a segment are transferred from the DMM while the AWG
+        is set to the first voltage of the next segment.
+        """
+        awg, dmm = self._async_instruments()
+        voltages = np.asarray(voltages)
+        if dwell is None:
+            dwell = await dmm.call('reading_time')
+
+        fetches = []
+        for start in range(0, len(voltages), self.dmm.MAX_READINGS):
+            segment = voltages[start : start + self.dmm.MAX_READINGS]
+            # Overlaps the fetch of the previous segment, arm_burst waits
+            # for the fetch to finish since both use the DMM
+            await asyncio.gather(
+                awg.run(self.set_dc_voltage, segment[0]),
+                dmm.call('arm_burst', len(segment)),
+            )
+            for voltage in segment:
+                await awg.run(self.set_dc_voltage, voltage)
+                await asyncio.sleep(settle)
+                await awg.run(self.trig_external)
+                await asyncio.sleep(dwell)
+            fetch = dmm.call('fetch_burst', len(segment))
+            fetches.append(asyncio.ensure_future(fetch))
+        v_shunt = np.concatenate(await asyncio.gather(*fetches))
+
+        current = v_shunt / self.r_shunt
+        v_output = 50 * current  # Signal source has 50ohm output
+        v_dut = voltages - v_shunt - v_output
+        return current, v_dut, v_shunt
+
+    def upload_arb(self, channel, name, values, sample_rate):
+        """
+        Upload a list of voltages as an arbitrary waveform on a channel,
+        played at sample_rate points per second.
+        """
+        values = np.asarray(values, dtype=float)
+        high = values.max()
+        low = values.min()
+        # The AWG needs a non-zero amplitude
+        amplitude = max(high - low, 1e-3)
+        offset = (high + low) / 2
+        normalised = (values - offset) / (amplitude / 2)
+
+        with self.awg.batch():
+            # The waveform in use cannot be cleared, switch away from it first
+            self.awg.write('SOURCE{}:FUNCTION DC'.format(channel))
+            self.awg.write('SOURCE{}:DATA:VOLATILE:CLEAR'.format(channel))
+            cmd = 'SOURCE{}:DATA:ARBITRARY {}, '.format(channel, name)
+            self.awg.write_ascii_values(cmd, normalised)
+            self.awg.write('SOURCE{}:FUNCTION:ARBITRARY {}'.format(channel, name))
+            self.awg.write('SOURCE{}:FUNCTION ARB'.format(channel))
+            cmd = 'SOURCE{}:FUNCTION:ARBITRARY:SRATE {}'.format(channel, sample_rate)
+            self.awg.write(cmd)
+            self.awg.write('SOURCE{}:VOLTAGE {:.6f}'.format(channel, amplitude))
+            self.awg.write('SOURCE{}:VOLTAGE:OFFSET {:.6f}'.format(channel, offset))
+            # Play the waveform once per trigger
+            self.awg.write('SOURCE{}:BURST:MODE TRIGGERED'.format(channel))
+            self.awg.write('SOURCE{}:BURST:NCYCLES 1'.format(channel))
+            self.awg.write('SOURCE{}:BURST:STATE ON'.format(channel))
+            self.awg.write('TRIGGER{}:SOURCE BUS'.format(channel))
+
+    def read_hardware_timed(self, voltages, settle=0.002, dwell=None, points=16):
+        """
+        Hardware-timed version of read_burst: the voltages are uploaded to
+        channel 1 as a staircase and channel 2 gets a matching pattern that
+        falls from 3V to 0V `settle` after the start of each step, which
+        triggers the DMM. Both waveforms are started together and the
+        readings fetched in bulk, no host timing is involved.
+        Each step lasts settle + dwell and is `points` arb points long.
+        Returns arrays of current, v_dut and v_shunt.
+        """
+        voltages = np.asarray(voltages)
+        if len(voltages) == 0:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        if dwell is None:
+            dwell = self.dmm.reading_time()
+        step_time = settle + dwell
+        sample_rate = points / step_time
+        trigger_point = max(1, int(round(points * settle / step_time)))
+        trigger_step = np.zeros(points)
+        trigger_step[:trigger_point] = 3
+
+        segments = []
+        for start in range(0, len(voltages), self.dmm.MAX_READINGS):
+            segment = voltages[start : start + self.dmm.MAX_READINGS]
+            staircase = np.repeat(segment, points)
+            triggers = np.tile(trigger_step, len(segment))
+            self.upload_arb(1, 'STAIRCASE', staircase, sample_rate)
+            self.upload_arb(2, 'TRIGGERS', triggers, sample_rate)
+            self.awg.write('SOURCE1:FUNCTION:ARBITRARY:SYNCHRONIZE')
+            self.dmm.arm_burst(len(segment))
+            self.awg.write('*TRG')
+            time.sleep(len(segment) * step_time)
+            segments.append(self.dmm.fetch_burst(len(segment)))
+        v_shunt = np.concatenate(segments)
+
+        # Back to plain DC on both channels
+        self._init_channel(2)
         self._init_channel(1, dc=True)
-        time.sleep(0.5)
 
-        voltage = v_from
-        v_dut = 0
+        current = v_shunt / self.r_shunt
+        v_output = 50 * current  # Signal source has 50ohm output
+        v_dut = voltages - v_shunt - v_output
+        return current, v_dut, v_shunt
+
+    def iv_curve(
+        self,
+        v_from,
+        v_to,
+        v_step,
+        burst=False,
+        hardware_timed=False,
+        stepper=None,
+        v_total_to=None,
+    ):
+        """
+        Simulated current-step iv-curve up to v_to over the DUT. Total
+        voltage is in each step increased by v_step + previous v_shunt in
+        an attempt to make v_dut spacing approximately constant.
+        With burst, the total voltage is stepped on a fixed grid from
+        v_from to v_total_to and all readings are fetched from the DMM in
+        bulk; v_dut then ends below v_total_to by the voltage over the
+        shunt and v_to is not used. With hardware_timed the same steps are
+        played by the AWG, see read_hardware_timed.
+        stepper is an optional AdaptiveStepper that replaces v_step
+        (not with burst or hardware_timed).
+        """
+        if burst or hardware_timed:
+            if v_total_to is None:
+                raise ValueError('burst and hardware_timed need v_total_to')
+            v_to = v_total_to
         if v_to < v_from:
             print('Error v_from must by lower than v_to!')
             return
+        self._init_channel(1, dc=True)
+        time.sleep(0.5)
+
+        if burst or hardware_timed:
+            voltages = np.arange(v_from, v_total_to + v_step / 2, v_step)
+            if hardware_timed:
+                current, v_dut, v_shunt = self.read_hardware_timed(voltages)
+            else:
+                current, v_dut, v_shunt = self.read_burst(voltages)
+            for i in range(len(voltages)):
+                self.writer.write_line(
+                    time=time.time() - self.t_start,
+                    v_total=voltages[i],
+                    v_shunt=v_shunt[i],
+                    current=current[i],
+                    v_dut=v_dut[i],
+                    di_dv=0,
+                    di=0,
+                    phase=0,
+                )
+            self.set_dc_voltage(0)
+            return
 
+        voltage = v_from
+        v_dut = 0
         v_shunt = 0
-        while v_dut < v_to:
+        if stepper is not None:
+            stepper.reset()
+        while v_dut < v_to and not self._budget_used(stepper):
             # Add previous v_shunt in an attempt to achive
             # constant v_dut step size
             v_actual = voltage + v_shunt
@@ -205,7 +663,7 @@ class DCMeasurement:
 
             msg = 'Vdut: {:.3f}V, I: {:.3f}mA'
             print(msg.format(v_dut, current * 1e3))
-            voltage = voltage + v_step
+            voltage = voltage + self._step(stepper, v_step, v_dut, current, v_to)
 
             self.writer.write_line(
                 time=time.time() - self.t_start,
@@ -215,14 +673,68 @@ class DCMeasurement:
                 v_dut=v_dut,
                 di_dv=0,
                 di=0,
+                phase=0,
             )
         self.set_dc_voltage(0)
 
-    def ac_sweep(self, v_from, v_to, v_step, amplitude):
+    async def iv_curve_async(self, v_from, v_total_to, v_step):
+        """
+        iv_curve in burst mode (the total voltage is stepped up to
+        v_total_to), with read_burst_async.
+        Run with asyncio.run(DG.iv_curve_async(...)).
+        """
+        if v_total_to < v_from:
+            print('Error v_from must by lower than v_total_to!')
+            return
+        await asyncio.to_thread(self._init_channel, 1, True)
+        await asyncio.sleep(0.5)
+        voltages = np.arange(v_from, v_total_to + v_step / 2, v_step)
+        current, v_dut, v_shunt = await self.read_burst_async(voltages)
+        for i in range(len(voltages)):
+            self.writer.write_line(
+                time=time.time() - self.t_start,
+                v_total=voltages[i],
+                v_shunt=v_shunt[i],
+                current=current[i],
+                v_dut=v_dut[i],
+                di_dv=0,
+                di=0,
+                phase=0,
+            )
+        await asyncio.to_thread(self.set_dc_voltage, 0)
+
+    def ac_sweep(
+        self,
+        v_from,
+        v_to,
+        v_step,
+        amplitude,
+        two_pass=False,
+        block=None,
+        stepper=None,
+        detector='dmm',
+    ):
+        """
+        AC-measurement of dI/dV. With detector='dmm' the DMM is switched
+        between DC and AC for every point, with two_pass see
+        _ac_sweep_two_pass. With detector='daq' both the DC and the AC
+        part of the shunt voltage come from the DAQ lock-in, the DMM is
+        not used, and the phase of the AC part is written as well.
+        stepper is an optional AdaptiveStepper that replaces v_step
+        (not with two_pass).
+        """
+        if detector not in ('dmm', 'daq'):
+            raise ValueError('Unknown detector: {}'.format(detector))
+        if detector == 'daq' and self.lockin is None:
+            raise ValueError('A DaqLockIn is needed for the daq detector')
         self._init_channel(1, dc=False)
         self.set_ac_voltage(amplitude)
-        self.dmm.set_voltage_mode(dc=False)
+        if detector == 'dmm':
+            self.dmm.set_voltage_mode(dc=False)
         time.sleep(0.5)
+        if two_pass and detector == 'dmm':
+            self._ac_sweep_two_pass(v_from, v_to, v_step, amplitude, block)
+            return
 
         voltage = v_from
         v_dut = 0
@@ -231,26 +743,81 @@ class DCMeasurement:
             return
 
         v_shunt = 0
-        while v_dut < v_to:
+        if stepper is not None:
+            stepper.reset()
+        while v_dut < v_to and not self._budget_used(stepper):
             # Add previous v_shunt in an attempt to achive
             # constant v_dut step size
             v_actual = voltage + v_shunt
             self.set_dc_voltage(v_actual)
-            time.sleep(0.1)
-            self.dmm.set_voltage_mode(dc=True)
-            time.sleep(0.75)
-            self.dmm.prepare_read()
-            self.trig_external()
-            v_shunt = self.dmm.read_after_trigger()
+            if detector == 'daq':
+                v_shunt, dV_shunt, phase = self._lockin_read()
+            else:
+                # The DMM does not give the phase
+                phase = 0
+                self.dmm.set_voltage_mode(dc=True)
+                v_shunt = self._settled_read(self.dc_settle, 0.85)
+                self.dmm.set_voltage_mode(dc=False)
+                dV_shunt = self._settled_read(self.ac_settle, 2.0) * 2 ** (1.5)
             current = v_shunt / self.r_shunt
             v_output = 50 * current  # Signal source has 50ohm output
             v_dut = v_actual - v_shunt - v_output
 
-            self.dmm.set_voltage_mode(dc=False)
-            time.sleep(2.0)
-            self.dmm.prepare_read()
-            self.trig_external()
-            dV_shunt = self.dmm.read_after_trigger() * 2 ** (1.5)
+            di = dV_shunt / self.r_shunt
+            dv = amplitude - di * (self.r_shunt + 50)
+            di_dv = di / dv
+
+            msg = 'dI: {:.3f}uA, Vdut: {:.3f}V, I: {:.3f}mA, di/dv: {:.3f}mA/V'
+            print(msg.format(di * 1e6, v_dut, current * 1e3, di_dv * 1e3))
+            step = self._step(stepper, v_step, v_dut, current, v_to, di_dv)
+            voltage = voltage + v_output + step
+            self.writer.write_line(
+                time=time.time() - self.t_start,
+                v_total=voltage,
+                v_shunt=v_shunt,
+                current=current,
+                v_dut=v_dut,
+                di_dv=di_dv,
+                di=di,
+                phase=phase,
+            )
+        self.set_dc_voltage(0)
+
+    async def ac_sweep_async(self, v_from, v_to, v_step, amplitude):
+        """
+        ac_sweep (DMM detector) with the bias set on the AWG while the DMM
+        changes to DC-mode. Run with asyncio.run(DG.ac_sweep_async(...)).
+        """
+        awg, dmm = self._async_instruments()
+        await asyncio.to_thread(self._init_channel, 1, False)
+        await awg.run(self.set_ac_voltage, amplitude)
+        await dmm.call('set_voltage_mode', False)
+        await asyncio.sleep(0.5)
+
+        voltage = v_from
+        v_dut = 0
+        if v_to < v_from:
+            print('Error v_from must by lower than v_to!')
+            return
+
+        v_shunt = 0
+        while v_dut < v_to:
+            # Add previous v_shunt in an attempt to achive
+            # constant v_dut step size
+            v_actual = voltage + v_shunt
+            await asyncio.gather(
+                awg.run(self.set_dc_voltage, v_actual),
+                dmm.call('set_voltage_mode', True),
+            )
+            await asyncio.sleep(0.85)
+            v_shunt = await self._read_shunt_async()
+            current = v_shunt / self.r_shunt
+            v_output = 50 * current  # Signal source has 50ohm output
+            v_dut = v_actual - v_shunt - v_output
+
+            await dmm.call('set_voltage_mode', False)
+            await asyncio.sleep(2.0)
+            dV_shunt = await self._read_shunt_async() * 2 ** (1.5)
             di = dV_shunt / self.r_shunt
             dv = amplitude - di * (self.r_shunt + 50)
             di_dv = di / dv
@@ -266,16 +833,148 @@ class DCMeasurement:
                 v_dut=v_dut,
                 di_dv=di_dv,
                 di=di,
+                phase=0,
             )
+        await awg.run(self.set_dc_voltage, 0)
+
+    def _ac_sweep_two_pass(
+        self, v_from, v_to, v_step, amplitude, block=None, ac_wait=1.0
+    ):
+        """
+        ac_sweep with the DMM switched between DC and AC once per pass
+        instead of twice per point. The first pass steps the total
+        voltage by about v_step from v_from and reads the DC shunt voltage
+        until v_dut reaches v_to. The second pass reads dI in AC-mode at total
+        voltages interpolated from the first pass to give a uniform v_dut
+        grid, v_shunt and current at those voltages are interpolated too.
+        With block, the passes alternate for every `block` DC points, so
+        long sweeps do not rely on the DUT being stable for the whole sweep.
+        """
+        if v_to < v_from:
+            print('Error v_from must by lower than v_to!')
+            return
+
+        voltage = v_from
+        v_dut = 0
+        v_shunt = 0
+        v_output = 0
+        grid_start = None
+        done = -1  # Index of the last grid point measured
+        ladder = []  # v_total, v_shunt, current and v_dut of the DC pass
+        while v_dut < v_to:
+            # DC pass
+            self.dmm.set_voltage_mode(dc=True)
+            time.sleep(0.75)
+            # Keep the last point of the previous block to interpolate from
+            ladder = ladder[-1:]
+            block_start = len(ladder)
+            while v_dut < v_to:
+                if block is not None and len(ladder) - block_start >= block:
+                    break
+                # Add previous v_shunt and v_output in an attempt to
+                # achive constant v_dut step size
+                v_actual = voltage + v_shunt + v_output
+                self.set_dc_voltage(v_actual)
+                time.sleep(0.1)
+                v_shunt = self._read_shunt()
+                current = v_shunt / self.r_shunt
+                v_output = 50 * current  # Signal source has 50ohm output
+                v_dut = v_actual - v_shunt - v_output
+                ladder.append((v_actual, v_shunt, current, v_dut))
+                voltage = voltage + v_step
+
+            v_total, v_shunts, currents, v_duts = np.array(ladder).T
+            if grid_start is None:
+                grid_start = v_duts[0]
+            # np.interp needs increasing values, noise could break that
+            v_duts = np.maximum.accumulate(v_duts)
+            first = max(np.ceil((v_duts[0] - grid_start) / v_step - 1e-9), done + 1)
+            last = np.floor((min(v_duts[-1], v_to) - grid_start) / v_step + 1e-9)
+            targets = grid_start + v_step * np.arange(first, last + 1)
+            if len(targets) == 0:
+                continue
+            done = last
+
+            # AC pass
+            self.dmm.set_voltage_mode(dc=False)
+            time.sleep(2.0)
+            for target in targets:
+                v_actual = np.interp(target, v_duts, v_total)
+                self.set_dc_voltage(v_actual)
+                dV_shunt = self._settled_read(self.ac_settle, ac_wait) * 2 ** (1.5)
+                di = dV_shunt / self.r_shunt
+                dv = amplitude - di * (self.r_shunt + 50)
+                di_dv = di / dv
+                v_shunt = np.interp(v_actual, v_total, v_shunts)
+                current = np.interp(v_actual, v_total, currents)
+
+                msg = 'dI: {:.3f}uA, Vdut: {:.3f}V, I: {:.3f}mA, di/dv: {:.3f}mA/V'
+                print(msg.format(di * 1e6, target, current * 1e3, di_dv * 1e3))
+                self.writer.write_line(
+                    time=time.time() - self.t_start,
+                    v_total=v_actual,
+                    v_shunt=v_shunt,
+                    current=current,
+                    v_dut=target,
+                    di_dv=di_dv,
+                    di=di,
+                    phase=0,
+                )
         self.set_dc_voltage(0)
 
-    def delta_sweep(self, v_from, v_to, v_step, v_delta):
+    def delta_sweep(
+        self,
+        v_from,
+        v_to,
+        v_step,
+        v_delta,
+        burst=False,
+        hardware_timed=False,
+        sliding=False,
+        stepper=None,
+        v_total_to=None,
+    ):
+        """
+        Delta-mode measurement of dI/dV up to v_to over the DUT. By
+        default three readings (+delta, -delta, +delta) are taken at each
+        point, with sliding see _delta_sweep_sliding. burst and
+        hardware_timed select how the readings are taken, see read_burst
+        and read_hardware_timed.
+        sliding, burst and hardware_timed step the total voltage on a
+        fixed grid up to v_total_to instead; v_dut then ends below
+        v_total_to by the voltage over the shunt and v_to is not used.
+        stepper is an optional AdaptiveStepper that replaces v_step
+        (only with the default three readings per point).
+        """
+        fixed_grid = sliding or burst or hardware_timed
+        if fixed_grid:
+            if v_total_to is None:
+                raise ValueError('sliding, burst and hardware_timed need v_total_to')
+            v_to = v_total_to
+        if v_to < v_from:
+            print('Error v_from must by lower than v_to!')
+            return
         self._init_channel(1, dc=True)
         time.sleep(0.5)
+        if fixed_grid:
+            if hardware_timed:
+                read = self.read_hardware_timed
+            elif burst:
+                read = self.read_burst
+            else:
+                read = self.read_voltages
+            if sliding:
+                self._delta_sweep_sliding(v_from, v_total_to, v_step, v_delta, read)
+            else:
+                self._delta_sweep_burst(v_from, v_total_to, v_step, v_delta, read)
+            return
+
         voltage = v_from
         v_shunt = 0
         v_dut = 0
-        while v_dut < v_to:
+        if stepper is not None:
+            stepper.reset()
+        while v_dut < v_to and not self._budget_used(stepper):
             # Voltage is the wanted voltage on the DUT, add approximate v_shunt
             # to the total voltage
             v_actual = voltage + v_shunt
@@ -289,12 +988,12 @@ class DCMeasurement:
 
             v_shunt = (v_shunt3 + v_shunt2) * 0.5
             current = (i3 + i2) * 0.5
-            voltage = voltage + v_step
 
             di = 0.5 * (0.5 * (i1 - i2) + 0.5 * (i3 - i2))
             dv = 0.5 * (0.5 * (v_dut1 - v_dut2) + 0.5 * (v_dut3 - v_dut2))
             di_dv = di / dv
             v_dut = (v_dut3 + v_dut2) * 0.5
+            voltage = voltage + self._step(stepper, v_step, v_dut, current, v_to, di_dv)
 
             msg = 'I: {:.3f}mA, di_dv: {:.3f}mA/V'
             print(msg.format(current * 1e3, di_dv * 1e3))
@@ -306,15 +1005,133 @@ class DCMeasurement:
                 v_dut=v_dut,
                 di_dv=di_dv,
                 di=di,
+                phase=0,
+            )
+        self.set_dc_voltage(0)
+
+    def _delta_sweep_burst(self, v_from, v_total_to, v_step, v_delta, read):
+        """
+        delta_sweep with the total voltage stepped from v_from to v_total_to and
+        the (+delta, -delta, +delta) readings of all points taken by `read`
+        (read_burst or read_hardware_timed).
+        """
+        biases = np.arange(v_from, v_total_to + v_step / 2, v_step)
+        if len(biases) == 0:
+            print('No points between v_from and v_to')
+            return
+        pattern = np.array([v_delta, -1 * v_delta, v_delta])
+        voltages = (biases[:, np.newaxis] + pattern).flatten()
+        i, v_dut, v_shunt = (x.reshape(-1, 3) for x in read(voltages))
+
+        current = (i[:, 2] + i[:, 1]) * 0.5
+        di = 0.5 * (0.5 * (i[:, 0] - i[:, 1]) + 0.5 * (i[:, 2] - i[:, 1]))
+        dv = 0.5 * (
+            0.5 * (v_dut[:, 0] - v_dut[:, 1]) + 0.5 * (v_dut[:, 2] - v_dut[:, 1])
+        )
+        di_dv = di / dv
+        for n in range(len(biases)):
+            self.writer.write_line(
+                time=time.time() - self.t_start,
+                v_total=biases[n],
+                v_shunt=(v_shunt[n, 2] + v_shunt[n, 1]) * 0.5,
+                current=current[n],
+                v_dut=(v_dut[n, 2] + v_dut[n, 1]) * 0.5,
+                di_dv=di_dv[n],
+                di=di[n],
+                phase=0,
+            )
+        self.set_dc_voltage(0)
+
+    def _delta_sweep_sliding(self, v_from, v_total_to, v_step, v_delta, read):
+        """
+        delta_sweep with a single alternating sequence over the whole
+        sweep: reading n is taken at bias n + (-1)**n * delta, with the
+        bias increased by v_step for every reading. Each reading and its
+        two neighbours give an estimate
+        dI = +-((i[n-1] + i[n+1]) / 2 - i[n]), and likewise for dV.
+        The neighbours are on the other side of the bias, their mean
+        cancels a linear drift. The curvature of the iv-curve over the
+        bias step enters with alternating sign, so two consecutive
+        estimates are averaged to a point halfway between them.
+        Every reading is used in several points, there is about one
+        reading per point instead of three.
+        """
+        # Extra biases at each end, so points cover v_from to v_total_to
+        biases = np.arange(v_from - 1.5 * v_step, v_total_to + 2 * v_step, v_step)
+        if len(biases) < 4:
+            # Each point needs a reading on either side
+            print('No points between v_from and v_to')
+            return
+        sign = (-1) ** np.arange(len(biases))
+        i, v_dut, v_shunt = read(biases + sign * v_delta)
+
+        def window_mean(x):
+            # Weighted mean of the readings around each bias
+            centre = 0.25 * (x[:-2] + 2 * x[1:-1] + x[2:])
+            return 0.5 * (centre[:-1] + centre[1:])
+
+        def difference(x):
+            # (+delta) - (-delta) difference, the sign alternates
+            estimate = -1 * sign[1:-1] * (0.5 * (x[:-2] + x[2:]) - x[1:-1])
+            return 0.5 * (estimate[:-1] + estimate[1:])
+
+        di = 0.5 * difference(i)
+        dv = 0.5 * difference(v_dut)
+        di_dv = di / dv
+        current = window_mean(i)
+        v_dut = window_mean(v_dut)
+        v_shunt = window_mean(v_shunt)
+        v_total = 0.5 * (biases[1:-2] + biases[2:-1])
+        for n in range(len(di)):
+            self.writer.write_line(
+                time=time.time() - self.t_start,
+                v_total=v_total[n],
+                v_shunt=v_shunt[n],
+                current=current[n],
+                v_dut=v_dut[n],
+                di_dv=di_dv[n],
+                di=di[n],
+                phase=0,
             )
         self.set_dc_voltage(0)
 
 
 if __name__ == '__main__':
+    # Record the instrument I/O, see common.tracing
+    # tracing.enable('trace.json')
+    # Simulated DMM and AWG with a diode, see common.scpi_simulator
+    # from common.scpi_simulator import start_simulators
+    # start_simulators(dut='diode')
     DMM = Agilent34401a()
     DG = DCMeasurement(dmm=DMM, r_shunt=999.8)
+    # Wait for settled readings instead of the worst-case sleeps
+    # from common.settle import SettleDetector
+    # DG = DCMeasurement(
+    #     dmm=DMM,
+    #     r_shunt=999.8,
+    #     dc_settle=SettleDetector(1e-5, relative=1e-3),
+    #     ac_settle=SettleDetector(1e-6, relative=1e-2, timeout=10),
+    # )
 
     # DG.iv_curve(0, 0.8, 0.05)
+    # The burst modes step the total voltage, v_dut ends below v_total_to
+    # DG.iv_curve(0, None, 0.05, burst=True, v_total_to=1.2)
+    # DG.iv_curve(0, None, 0.05, hardware_timed=True, v_total_to=1.2)
+    # asyncio.run(DG.iv_curve_async(0, 1.2, 0.05))
+    # stepper = AdaptiveStepper(0.002, 0.05, di_target=20e-6, max_points=100)
+    # DG.iv_curve(0, 0.8, 0.05, stepper=stepper)
     DG.ac_sweep(1.2, 2.0, 0.02, 0.05)
+    # DG.ac_sweep(1.2, 2.0, 0.02, 0.05, two_pass=True)
+    # asyncio.run(DG.ac_sweep_async(1.2, 2.0, 0.02, 0.05))
+    # DG.ac_sweep(1.2, 2.0, 0.02, 0.05, two_pass=True, block=10)
     # DG.delta_sweep(v_from=1, v_to=2.3, v_step=0.05, v_delta=0.05)
     # DG.delta_sweep(v_from=0, v_to=0.5, v_step=0.025, v_delta=0.05)
+    # DG.delta_sweep(0, None, 0.025, 0.05, burst=True, sliding=True, v_total_to=0.8)
+    # print(DG.dc_settle.summary())
+    # print('AWG: ' + DG.awg.summary())
+    # print('DMM: ' + DMM.instr.summary())
+
+    # dI/dV from the DAQ instead of the AC-mode of the DMM
+    # LOCKIN = DaqLockIn('Dev1/ai0', reference='Dev1/ai1', periods=10)
+    # DG = DCMeasurement(dmm=DMM, r_shunt=999.8, lockin=LOCKIN)
+    # DG.ac_sweep(1.2, 2.0, 0.02, 0.05, detector='daq')
@@ -0,0 +1,156 @@
+import io
+import os
+import time
+import asyncio
+import tempfile
+import contextlib
+
+import numpy as np
+
+import multisine
+import simulated_backend
+import impedance_spectroscopy as imp
+
+
+def legacy_phase_search(x_data, data, freq):
+    """
+    The original initial guess: score 120 phase guesses against the
+    first 1500 samples, one sine_fit_func call per sample.
+    """
+    amp_guess = (max(data) - min(data)) / 2
+    if len(x_data) > 1500:
+        fit_length = 1500
+    else:
+        fit_length = len(x_data)
+
+    error_min = 99999999999
+    phase_guesses = np.arange(0, 6, 0.05)
+
+    for phase_guess in phase_guesses:
+        p0 = [amp_guess, phase_guess]
+        error = 0
+        for i in range(0, fit_length):
+            sine_fit = imp.sine_fit_func(p0, x_data[i], freq)
+            error += (data[i] - sine_fit) ** 2
+
+        if error < error_min:
+            error_min = error
+            phase = phase_guess
+    return [amp_guess, phase]
+
+
+def synthetic_signal(freq, amplitude=0.3, phase=1.2, noise=0.01, seed=0):
+    """
+    A noisy sine with the same record length as read_data(freq) would give.
+    """
+    rng = np.random.default_rng(seed)
+    samples = imp.record_length(freq)
+    x_data = np.arange(1, samples + 1) / imp.sample_rate
+    data = amplitude * np.sin(freq * x_data + phase)
+    data += rng.normal(0, noise, len(x_data))
+    return x_data, data
+
+
+def _time_it(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        value = func(*args)
+        dt = time.perf_counter() - t
+        if best is None or dt < best:
+            best = dt
+    return best, value
+
+
+def benchmark_initial_guess(freqs=(100, 1000, 10000)):
+    msg = '{:>8.0f}  {:>8d}  {:>9.2f}ms  {:>9.2f}ms  {:>7.0f}x  {:.3f} / {:.3f}'
+    print('    freq   samples     legacy     closed   speedup  phase (legacy / closed)')
+    for freq in freqs:
+        x_data, data = synthetic_signal(freq)
+        t_legacy, p_legacy = _time_it(legacy_phase_search, x_data, list(data), freq)
+        t_closed, p_closed = _time_it(imp.initial_guess, x_data, data, freq)
+        print(
+            msg.format(
+                freq,
+                len(x_data),
+                t_legacy * 1e3,
+                t_closed * 1e3,
+                t_legacy / t_closed,
+                p_legacy[1],
+                p_closed[1],
+            )
+        )
+
+
+SWEEPS = {
+    'fit': lambda: imp.perform_a_sweep(estimator='fit'),
+    'lockin': lambda: imp.perform_a_sweep(estimator='lockin'),
+    'joint': lambda: imp.perform_a_sweep(estimator='joint'),
+    'adaptive': lambda: imp.perform_a_sweep(estimator='lockin', adaptive=True),
+    'pipelined': lambda: imp.perform_pipelined_sweep(estimator='fit'),
+    'async': lambda: asyncio.run(imp.perform_async_sweep(estimator='lockin')),
+    'broadband': lambda: multisine.perform_broadband_sweep(),
+}
+
+
+def benchmark_sweeps(sweeps=None, circuit='RC', time_scale=1, **backend_args):
+    """
+    Run complete sweeps against the simulated backend and report points
+    per second, the mean latency of each stage and the largest deviation
+    from the circuit model. 'other' is the wall time not spent in the
+    backend, ie. mainly analysis (it overlaps acquisition when pipelined).
+    """
+    if sweeps is None:
+        sweeps = list(SWEEPS)
+    imp.RENDER_MODE = 'headless'
+    print(
+        'sweep      points     wall  points/s     set_freq      acquire'
+        '        other   err |Z| err phase'
+    )
+    msg = '{:<10} {:>6d} {:>7.2f}s {:>9.2f} {:>10.1f}ms {:>10.1f}ms {:>10.1f}ms'
+    msg += ' {:>9.1e} {:>9.1e}'
+    for name in sweeps:
+        backend = simulated_backend.use_simulated_backend(
+            circuit, time_scale=time_scale, seed=0, **backend_args
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                t = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    SWEEPS[name]()
+                wall = time.perf_counter() - t
+                results = np.loadtxt('results.csv', delimiter=';', ndmin=2)
+            finally:
+                os.chdir(cwd)
+
+        points = len(results)
+        set_time = np.sum(backend.timings['set_frequency'])
+        acquire_time = np.sum(backend.timings['acquire'])
+        other = wall - set_time - acquire_time
+        z_true = backend.impedance(results[:, 0])
+        z_error = np.max(np.abs(results[:, 1] / np.abs(z_true) - 1))
+        # The measured phase shift is -arg(Z), compare wrapped to +-pi
+        phase_diff = np.exp(1j * (results[:, 2] + np.angle(z_true)))
+        phase_error = np.max(np.abs(np.angle(phase_diff)))
+        print(
+            msg.format(
+                name,
+                points,
+                wall,
+                points / wall,
+                1e3 * set_time / points,
+                1e3 * acquire_time / points,
+                1e3 * other / points,
+                z_error,
+                phase_error,
+            )
+        )
+    imp.use_backend(None)
+
+
+if __name__ == '__main__':
+    benchmark_initial_guess()
+    print()
+    benchmark_sweeps()
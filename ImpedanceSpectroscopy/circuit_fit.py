@@ -0,0 +1,161 @@
+import csv
+import argparse
+import concurrent.futures
+
+import numpy as np
+import scipy as sp
+
+
+# Impedance of the equivalent circuits for an array of angular
+# frequencies w and the component values
+def resistor(w, R):
+    return R + 0 * w
+
+
+def series_rc(w, R, C):
+    return R + 1 / (1j * w * C)
+
+
+def parallel_rc(w, R, C):
+    return R / (1 + 1j * w * R * C)
+
+
+def r_parallel_rc(w, Rs, R, C):
+    return Rs + R / (1 + 1j * w * R * C)
+
+
+def r_parallel_rcpe(w, Rs, R, Q, n):
+    return Rs + R / (1 + R * Q * (1j * w) ** n)
+
+
+def randles(w, Rs, Rct, Cdl, W):
+    faradaic = Rct + W * (1 - 1j) / np.sqrt(w)
+    return Rs + faradaic / (1 + 1j * w * Cdl * faradaic)
+
+
+# Equivalent circuits: the impedance function and its component names
+MODELS = {
+    'R': (resistor, ['R']),
+    'series_RC': (series_rc, ['R', 'C']),
+    'parallel_RC': (parallel_rc, ['R', 'C']),
+    'R_parallel_RC': (r_parallel_rc, ['Rs', 'R', 'C']),
+    'R_parallel_RCPE': (r_parallel_rcpe, ['Rs', 'R', 'Q', 'n']),
+    'randles': (randles, ['Rs', 'Rct', 'Cdl', 'W']),
+}
+
+# Allowed range of each kind of component value
+BOUNDS = {
+    'R': (1e-1, 1e7),
+    'Rs': (1e-1, 1e7),
+    'Rct': (1e-1, 1e7),
+    'C': (1e-12, 1e-1),
+    'Cdl': (1e-12, 1e-1),
+    'Q': (1e-12, 1e-1),
+    'W': (1e-1, 1e6),
+    'n': (0.3, 1),
+}
+
+
+def load_spectrum(filename):
+    """
+    Read a results.csv file. Returns angular frequency and complex
+    impedance. The phase shift in the file is current phase - voltage
+    phase, ie. -arg(Z).
+    """
+    data = np.loadtxt(filename, delimiter=';', ndmin=2)
+    w = data[:, 0]
+    impedance = data[:, 1] * np.exp(-1j * data[:, 2])
+    return w, impedance
+
+
+def _residual(log_params, model, w, impedance):
+    error = (model(w, *10**log_params) - impedance) / np.abs(impedance)
+    return np.concatenate((error.real, error.imag))
+
+
+def fit_model(name, w, impedance, starts=20, seed=0):
+    """
+    Fit one model with a number of random starting points, log-uniformly
+    distributed within BOUNDS. The fit is done in log10 of the component
+    values. Returns the best parameters and the corresponding cost.
+    """
+    model, params = MODELS[name]
+    lower = np.log10([BOUNDS[param][0] for param in params])
+    upper = np.log10([BOUNDS[param][1] for param in params])
+    rng = np.random.default_rng(seed)
+
+    best = None
+    for p0 in rng.uniform(lower, upper, size=(starts, len(params))):
+        fit = sp.optimize.least_squares(
+            _residual,
+            p0,
+            bounds=(lower, upper),
+            args=(model, w, impedance),
+        )
+        if best is None or fit.cost < best.cost:
+            best = fit
+    return dict(zip(params, 10**best.x)), best.cost
+
+
+def _fit_task(filename, name, starts, seed):
+    w, impedance = load_spectrum(filename)
+    values, cost = fit_model(name, w, impedance, starts, seed)
+    # Akaike information criterion for a least-squares fit, used to
+    # compare models with different number of parameters
+    points = 2 * len(w)
+    aic = points * np.log(2 * cost / points) + 2 * len(values)
+    return {
+        'file': filename,
+        'model': name,
+        'cost': cost,
+        'aic': aic,
+        'values': values,
+    }
+
+
+def fit_spectra(filenames, models=None, starts=20, workers=None, seed=0):
+    """
+    Fit every model to every spectrum, each (spectrum, model) pair is a
+    task in a process pool. The starts of a fit run one after the other
+    in its task, so more workers than pairs do not help. Returns a list
+    of fit results, sorted by file and AIC so the preferred model for
+    each spectrum comes first.
+    """
+    if models is None:
+        models = list(MODELS)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_fit_task, filename, name, starts, seed)
+            for filename in filenames
+            for name in models
+        ]
+        fits = [future.result() for future in futures]
+    fits.sort(key=lambda fit: (fit['file'], fit['aic']))
+    return fits
+
+
+def write_fits(fits, filename='circuit_fits.csv'):
+    with open(filename, 'w', newline='\n') as datafile:
+        datawriter = csv.writer(datafile, delimiter=';')
+        for fit in fits:
+            row = [fit['file'], fit['model'], fit['cost'], fit['aic']]
+            for param, value in fit['values'].items():
+                row.append('{}={:.6g}'.format(param, value))
+            datawriter.writerow(row)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit equivalent circuits')
+    parser.add_argument('files', nargs='+', help='results.csv files')
+    parser.add_argument('--models', nargs='+', default=None, choices=list(MODELS))
+    parser.add_argument('--starts', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default='circuit_fits.csv')
+    args = parser.parse_args()
+
+    fits = fit_spectra(args.files, args.models, args.starts, args.workers)
+    msg = '{}: {:<16} AIC={:8.1f} {}'
+    for fit in fits:
+        values = ', '.join('{}={:.4g}'.format(*item) for item in fit['values'].items())
+        print(msg.format(fit['file'], fit['model'], fit['aic'], values))
+    write_fits(fits, args.output)
@@ -1,19 +1,35 @@
 import csv
+import os
+import sys
+import atexit
 import math
 import time
-import pyvisa
-import nidaqmx
+import asyncio
+import pathlib
+import threading
+import collections
+import concurrent.futures
 import numpy as np
 import scipy as sp
 
-import matplotlib.pyplot as plt
+try:
+    import nidaqmx
+    from nidaqmx.stream_readers import AnalogMultiChannelReader
+except ImportError:
+    # The analysis (eg. replay of archived waveforms) works without the DAQ
+    nidaqmx = None
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from common import tracing  # noqa: E402
+from common.async_instruments import AsyncInstrument, ordered  # noqa: E402
 
 
 sample_rate = 5e5
 min_val = -1
 max_val = 1
 # samples = 100000
-terminal_config = nidaqmx.constants.TerminalConfiguration.DIFF
+if nidaqmx is not None:
+    terminal_config = nidaqmx.constants.TerminalConfiguration.DIFF
 
 FIT_PARAMS = {
     # 'method': 'lm',
@@ -27,41 +43,146 @@ FIT_PARAMS = {
     # 'max_nfev': 1000,
 }
 
+# How diagnostic plots are handled:
+# 'interactive': show each plot and wait for the window to be closed
+# 'headless': skip all plots, matplotlib is never imported
+# 'deferred': collect the plots and render them to image files in
+#             FIGURE_DIR when the sweep is done
+RENDER_MODE = 'interactive'
+FIGURE_DIR = 'figures'
+_deferred_plots = []
+
+# Replaces the AWG and the DAQ if set, see use_backend()
+BACKEND = None
+
+# The joint fit provides its own analytical jacobian and needs a plain
+# least-squares loss for the covariance estimate to be meaningful
+JOINT_FIT_PARAMS = {
+    "method": "lm",
+    "x_scale": "jac",
+    "ftol": 1e-12,
+    "xtol": 1e-12,
+    "gtol": 1e-12,
+    "max_nfev": 200,
+}
+
 
-def read_data(freq):
-    samples = 2 * np.pi * 3 * math.floor((sample_rate / freq))
-    x_data = np.arange(1.0 / sample_rate, samples / sample_rate, 1.0 / sample_rate)
-    # Due to rounding, x_data can miss a point, make sure they have
-    # same length:
-    samples = len(x_data)
+class DaqAcquisition:
+    """
+    Keeps a single DAQ task open for the whole sweep and reads both
+    channels directly into a preallocated float64 buffer, only the
+    timing is reconfigured between acquisitions.
+    """
 
-    with nidaqmx.Task() as task:
+    def __init__(self, max_samples=2**17):
+        self.task = nidaqmx.Task()
         # 9V label
-        task.ai_channels.add_ai_voltage_chan(
+        self.task.ai_channels.add_ai_voltage_chan(
             "Dev1/ai3",
             terminal_config=terminal_config,
             min_val=min_val,
             max_val=max_val,
         )
         # H label
-        task.ai_channels.add_ai_voltage_chan(
+        self.task.ai_channels.add_ai_voltage_chan(
             "Dev1/ai2",
             terminal_config=terminal_config,
             min_val=min_val,
             max_val=max_val,
         )
-
-        task.timing.cfg_samp_clk_timing(
+        self.reader = AnalogMultiChannelReader(self.task.in_stream)
+        self.buffer = np.zeros(2 * max_samples)
+
+    def read(self, samples):
+        """
+        Read a number of samples from both channels. The returned array is
+        a view into the buffer and is only valid until the next read.
+        """
+        if 2 * samples > len(self.buffer):
+            self.buffer = np.zeros(2 * samples)
+        # A contiguous (channels, samples) view, as required by the reader
+        data = self.buffer[: 2 * samples].reshape(2, samples)
+
+        self.task.timing.cfg_samp_clk_timing(
             rate=sample_rate,
             sample_mode=nidaqmx.constants.AcquisitionType.FINITE,
-            samps_per_chan=samples * 2,
+            samps_per_chan=samples,
         )
-        data = task.read(number_of_samples_per_channel=(samples))
+        with tracing.span('daq', 'read {} samples'.format(samples)) as span:
+            self.reader.read_many_sample(
+                data,
+                number_of_samples_per_channel=samples,
+                timeout=10 + samples / sample_rate,
+            )
+            self.task.stop()
+            span['bytes_in'] = data.nbytes
+        return data
+
+    def close(self):
+        self.task.close()
+
+
+_daq = None
+
+
+def acquire(samples):
+    """
+    Read a number of samples from both channels: current first, then voltage.
+    The data is a view into the buffer of the shared DaqAcquisition and
+    is overwritten by the next call, take a copy to keep it.
+    """
+    if BACKEND is not None:
+        return BACKEND.acquire(samples)
+    global _daq
+    if _daq is None:
+        _daq = DaqAcquisition()
+        atexit.register(_daq.close)
+    return _daq.read(samples)
+
+
+def record_length(freq, min_periods=3, tolerance=1e-3, max_periods=1000):
+    """
+    Number of samples for a record of an integer number of periods. The
+    record is the shortest with at least min_periods for which the
+    rounding to whole samples is less than `tolerance` of a period.
+    """
+    period_samples = 2 * np.pi * sample_rate / freq
+    periods = np.arange(min_periods, max_periods + 1)
+    exact = periods * period_samples
+    error = np.abs(np.round(exact) - exact) / period_samples
+    within = np.flatnonzero(error <= tolerance)
+    if len(within) > 0:
+        index = within[0]
+    else:
+        # The tolerance can not be met, use the best record available
+        index = np.argmin(error)
+    return int(round(exact[index]))
+
+
+def read_data(freq):
+    samples = record_length(freq)
+    x_data = np.arange(1, samples + 1) / sample_rate
+    data = acquire(samples)
     return x_data, data
 
 
 def plot_data(x, y1, y2=None, label1='y1', label2='y2'):
+    if RENDER_MODE == 'headless':
+        return
+    if RENDER_MODE == 'deferred':
+        if y2 is not None:
+            y2 = np.array(y2)
+        _deferred_plots.append((np.array(x), np.array(y1), y2, label1, label2))
+        return
+
+    import matplotlib.pyplot as plt
+
     fig = plt.figure()
+    draw_data(fig, x, y1, y2, label1, label2)
+    plt.show()
+
+
+def draw_data(fig, x, y1, y2=None, label1='y1', label2='y2'):
     fig.set_size_inches(20, 10)
 
     axis = fig.add_subplot(1, 1, 1)
@@ -74,18 +195,48 @@ def plot_data(x, y1, y2=None, label1='y1', label2='y2'):
     # axis.set_xlim(0, 5)
 
     axis.legend()
-    plt.show()
 
 
-def find_main_frequency(data):
+def render_deferred(directory=None):
+    """
+    Render the plots collected in 'deferred' mode to png-files in a
+    background thread. Returns the thread, the plots are done when it
+    has finished.
+    """
+    if directory is None:
+        directory = FIGURE_DIR
+    plots = list(_deferred_plots)
+    _deferred_plots.clear()
+    thread = threading.Thread(target=_render_plots, args=(plots, directory))
+    thread.start()
+    return thread
+
+
+def _render_plots(plots, directory):
+    # The object oriented interface does not touch the GUI, so it is
+    # safe to use outside the main thread
+    from matplotlib.figure import Figure
+
+    path = pathlib.Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    fig = Figure()
+    for i, plot in enumerate(plots):
+        fig.clf()
+        draw_data(fig, *plot)
+        fig.savefig(path / 'plot_{:03d}_{}.png'.format(i, plot[4].replace(' ', '_')))
+
+
+def find_main_frequency(data, rate=None):
     # Numpy magic to extract main tone
     # In principle we do not need this, since we set the frequency in the experiment
+    if rate is None:
+        rate = sample_rate
     mean_value = sum(data) / len(data)
     fft_data = abs(np.fft.fft(np.array(data) - mean_value))
     freqs = np.fft.fftfreq(len(data))
     peak_coefficient = np.argmax(np.abs(fft_data))
     peak_freq = freqs[peak_coefficient]
-    peak_freq_calibrated = abs(peak_freq * sample_rate)
+    peak_freq_calibrated = abs(peak_freq * rate)
     main_omega = peak_freq_calibrated * 2 * np.pi
     return main_omega
 
@@ -103,34 +254,36 @@ def sine_error_func(p, x, y, freq):
     return error
 
 
-def find_data_amp_and_phase(x_data, data):
-    freq = find_main_frequency(data)
-    # print('Detected frequency: {}Hz'.format(freq))
-    amp_guess = (max(data) - min(data)) / 2
-    print('Amplitude estimate: {:.1f}mV'.format(amp_guess * 1000))
-
-    if len(x_data) > 1500:
-        fit_length = 1500
-    else:
-        fit_length = len(x_data)
-
-    error_min = 99999999999
-    phase_guesses = np.arange(0, 6, 0.05)
+def initial_guess(x_data, data, freq):
+    """
+    Closed-form estimate of amplitude and phase. With a known frequency
+    the sine model is linear in a sin/cos basis:
+    a*sin(wt) + b*cos(wt) + c = A*sin(wt + phase) + c
+    so a single linear least-squares solve over all samples gives
+    A = sqrt(a^2 + b^2) and phase = atan2(b, a).
+    """
+    x_data = np.asarray(x_data)
+    basis = np.column_stack(
+        (
+            np.sin(freq * x_data),
+            np.cos(freq * x_data),
+            np.ones_like(x_data),
+        )
+    )
+    (a, b, _), *_ = np.linalg.lstsq(basis, np.asarray(data), rcond=None)
+    amplitude = np.hypot(a, b)
+    phase = np.arctan2(b, a) % (2 * np.pi)
+    return [amplitude, phase]
 
-    for phase_guess in phase_guesses:
-        p0 = [amp_guess, phase_guess]
-        error = 0
-        for i in range(0, fit_length):
-            sine_fit = sine_fit_func(p0, x_data[i], freq)
-            error += (data[i] - sine_fit) ** 2
 
-        if error < error_min:
-            error_min = error
-            phase = phase_guess
-    # print('Phase guess: ', phase)
-    p0 = [amp_guess, phase]
+def find_data_amp_and_phase(x_data, data, plot=True, rate=None):
+    freq = find_main_frequency(data, rate)
+    # print('Detected frequency: {}Hz'.format(freq))
+    p0 = initial_guess(x_data, data, freq)
+    print('Amplitude estimate: {:.1f}mV'.format(p0[0] * 1000))
+    # print('Phase guess: ', p0[1])
 
-    plot_initial_guess = True
+    plot_initial_guess = plot
     if plot_initial_guess:
         plot_data(x_data, data, sine_fit_func(p0, x_data, freq), 'raw', 'initial guess')
 
@@ -143,7 +296,7 @@ def find_data_amp_and_phase(x_data, data):
     )
 
     # If you want to plot the fitted data, uncomment here
-    plot_fitted = True
+    plot_fitted = plot
     if plot_fitted:
         plot_data(
             x_data, data, sine_fit_func(fit.x, x_data, freq), 'raw', 'fitted data'
@@ -154,29 +307,255 @@ def find_data_amp_and_phase(x_data, data):
     return amplitude, phase, fit
 
 
+def lock_in_amp_and_phase(x_data, data, freq, window='hann', integer_periods=True):
+    """
+    Digital lock-in: demodulate the data against the known reference
+    frequency and return amplitude and phase in the same convention as
+    sine_fit_func, ie. data ~ amplitude * sin(freq * x + phase).
+    With integer_periods the record is cut to a whole number of
+    reference periods, which removes the leakage of the mean value and
+    of the 2*freq term. window is either 'hann' or None (rectangular).
+    """
+    x_data = np.asarray(x_data)
+    data = np.asarray(data)
+    if integer_periods:
+        dt = x_data[1] - x_data[0]
+        period_samples = 2 * np.pi / (freq * dt)
+        periods = math.floor(len(x_data) / period_samples)
+        if periods > 0:
+            samples = int(round(periods * period_samples))
+            x_data = x_data[:samples]
+            data = data[:samples]
+
+    if window == 'hann':
+        weights = np.hanning(len(data))
+    elif window is None:
+        weights = np.ones(len(data))
+    else:
+        raise ValueError('Unknown window: {}'.format(window))
+    weights = weights / weights.sum()
+
+    signal = data - np.dot(weights, data)
+    in_phase = 2 * np.dot(weights, signal * np.sin(freq * x_data))
+    quadrature = 2 * np.dot(weights, signal * np.cos(freq * x_data))
+    amplitude = np.hypot(in_phase, quadrature)
+    phase = np.arctan2(quadrature, in_phase) % (2 * np.pi)
+    return amplitude, phase
+
+
+def joint_fit_func(p, x, fit_frequency, freq):
+    """
+    Model for both channels at once. Parameters are:
+    [i_amp, i_phase, ratio, phase_shift, i_offset, v_offset(, freq)]
+    current = i_amp * sin(freq * x + i_phase) + i_offset
+    voltage = ratio * i_amp * sin(freq * x + i_phase - phase_shift) + v_offset
+    """
+    if fit_frequency:
+        freq = p[6]
+    current = p[0] * np.sin(freq * x + p[1]) + p[4]
+    voltage = p[2] * p[0] * np.sin(freq * x + p[1] - p[3]) + p[5]
+    return current, voltage
+
+
+def joint_error_func(p, x, current, voltage, sigma, fit_frequency, freq):
+    model_i, model_v = joint_fit_func(p, x, fit_frequency, freq)
+    error = np.concatenate(
+        ((model_i - current) / sigma[0], (model_v - voltage) / sigma[1])
+    )
+    return error
+
+
+def joint_jacobian(p, x, current, voltage, sigma, fit_frequency, freq):
+    if fit_frequency:
+        freq = p[6]
+    i_amp, _, ratio, _ = p[0:4]
+    theta_i = freq * x + p[1]
+    theta_v = theta_i - p[3]
+    sin_i = np.sin(theta_i)
+    cos_i = np.cos(theta_i)
+    sin_v = np.sin(theta_v)
+    cos_v = np.cos(theta_v)
+
+    samples = len(x)
+    jac = np.zeros((2 * samples, len(p)))
+    jac_i = jac[:samples]
+    jac_v = jac[samples:]
+    jac_i[:, 0] = sin_i
+    jac_i[:, 1] = i_amp * cos_i
+    jac_i[:, 4] = 1
+    jac_v[:, 0] = ratio * sin_v
+    jac_v[:, 1] = ratio * i_amp * cos_v
+    jac_v[:, 2] = i_amp * sin_v
+    jac_v[:, 3] = -1 * ratio * i_amp * cos_v
+    jac_v[:, 5] = 1
+    if fit_frequency:
+        jac_i[:, 6] = i_amp * x * cos_i
+        jac_v[:, 6] = ratio * i_amp * x * cos_v
+    jac_i /= sigma[0]
+    jac_v /= sigma[1]
+    return jac
+
+
+def joint_fit(x_data, current, voltage, freq, fit_frequency=False):
+    """
+    Fit current and voltage simultaneously with a shared frequency and
+    time base. Returns amplitude ratio (voltage / current), phase shift
+    (current phase - voltage phase), their standard errors from the
+    covariance matrix and the raw fit result.
+    """
+    x_data = np.asarray(x_data)
+    current = np.asarray(current)
+    voltage = np.asarray(voltage)
+
+    # The closed-form guess is so close that the residual of the guess
+    # is a good estimate of the noise in each channel
+    i_amp, i_phase = initial_guess(x_data, current, freq)
+    v_amp, v_phase = initial_guess(x_data, voltage, freq)
+    p0 = [i_amp, i_phase, v_amp / i_amp, i_phase - v_phase, 0, 0]
+    p0[4] = np.mean(current - sine_fit_func(p0[0:2], x_data, freq))
+    p0[5] = np.mean(voltage - sine_fit_func([v_amp, v_phase], x_data, freq))
+    sigma = [
+        np.std(current - sine_fit_func([i_amp, i_phase], x_data, freq)),
+        np.std(voltage - sine_fit_func([v_amp, v_phase], x_data, freq)),
+    ]
+    if fit_frequency:
+        p0.append(freq)
+
+    fit = sp.optimize.least_squares(
+        joint_error_func,
+        p0,
+        jac=joint_jacobian,
+        args=(x_data, current, voltage, sigma, fit_frequency, freq),
+        **JOINT_FIT_PARAMS
+    )
+
+    dof = max(len(fit.fun) - len(fit.x), 1)
+    reduced_chi2 = 2 * fit.cost / dof
+    covariance = np.linalg.pinv(fit.jac.T @ fit.jac) * reduced_chi2
+    errors = np.sqrt(np.diag(covariance))
+
+    ratio = fit.x[2]
+    phase_shift = fit.x[3]
+    if ratio < 0:
+        # Equivalent solution with the voltage phase rotated by pi
+        ratio = -1 * ratio
+        phase_shift = phase_shift + np.pi
+    phase_shift = (phase_shift + np.pi) % (2 * np.pi) - np.pi
+    return ratio, phase_shift, errors[2], errors[3], fit
+
+
+def cross_check_estimate(x_data, data, amplitude, phase, tolerance=1e-2, plot=True):
+    """
+    Compare an amplitude and phase estimate with the least-squares fit.
+    Returns the relative amplitude difference and the phase difference
+    (wrapped to +-pi). A warning is printed if either is above tolerance.
+    """
+    fit_amp, fit_phase, _ = find_data_amp_and_phase(x_data, data, plot=plot)
+    # The fit is free to return a negative amplitude, compare as phasors
+    fitted = fit_amp * np.exp(1j * fit_phase)
+    estimate = amplitude * np.exp(1j * phase)
+    amp_diff = (abs(estimate) - abs(fitted)) / abs(fitted)
+    phase_diff = np.angle(estimate / fitted)
+    if abs(amp_diff) > tolerance or abs(phase_diff) > tolerance:
+        msg = 'Cross-check mismatch! Amplitude: {:.2e}, Phase: {:.2e}rad'
+        print(msg.format(amp_diff, phase_diff))
+    return amp_diff, phase_diff
+
+
+def use_backend(backend):
+    """
+    Run the measurement on another backend than the AWG and DAQ hardware,
+    eg. simulated_backend.SimulatedBackend. The backend must implement
+    set_frequency(freq), acquire(samples) and
+    upload_waveform(waveform, base_freq, amplitude). None selects the
+    hardware again.
+    """
+    global BACKEND
+    BACKEND = backend
+
+
+def open_awg():
+    # Imported here, pyvisa is not needed for offline analysis
+    from common.instrument_registry import get_instrument
+
+    awg = get_instrument(match="USB0")
+    return awg
+
+
 def set_frequency(freq):
+    if BACKEND is not None:
+        BACKEND.set_frequency(freq)
+        return
     rotational_frequency = freq / (2 * math.pi)
-    rm = pyvisa.ResourceManager()
-    for visaRsrcAddr in rm.list_resources():
-        if "USB0" in visaRsrcAddr:
-            break
-    awg = rm.open_resource(visaRsrcAddr)
+    awg = open_awg()
     awg.write("FREQ {}".format(rotational_frequency))
     time.sleep(0.1)
 
 
-def test_a_frequency(freq):
+def test_a_frequency(freq, estimator='fit', cross_check=False, archive=None):
+    """
+    Measure the impedance at a single frequency.
+    estimator is either 'fit' (least-squares sine fit of each channel),
+    'lockin' (digital IQ-demodulation at the known frequency) or 'joint'
+    (simultaneous fit of both channels). With cross_check the lock-in
+    result is compared to the fit. If an archive (see waveform_archive.py)
+    is given, the raw waveforms are stored in it.
+    Returns |Z|, phase shift and their uncertainties, the uncertainties
+    are only available (not nan) for the joint fit.
+    """
     set_frequency(freq)
     x_data, data = read_data(freq)
+    if archive is not None:
+        archive.append(data, sample_rate, freq=freq)
+    return analyse_a_frequency(freq, x_data, data, estimator, cross_check)
+
+
+def analyse_a_frequency(
+    freq, x_data, data, estimator='fit', cross_check=False, plot=True, rate=None
+):
+    """
+    The analysis part of test_a_frequency, see there. rate is the sample
+    rate of data, default sample_rate.
+    """
     current = data[0]
     voltage = data[1]
 
-    i_amp, i_phase, fit_i = find_data_amp_and_phase(x_data, current)
-    v_amp, v_phase, fit_v = find_data_amp_and_phase(x_data, voltage)
+    if estimator == 'fit':
+        i_amp, i_phase, _ = find_data_amp_and_phase(x_data, current, plot, rate)
+        v_amp, v_phase, _ = find_data_amp_and_phase(x_data, voltage, plot, rate)
+    elif estimator == 'lockin':
+        i_amp, i_phase = lock_in_amp_and_phase(x_data, current, freq)
+        v_amp, v_phase = lock_in_amp_and_phase(x_data, voltage, freq)
+        if cross_check:
+            cross_check_estimate(x_data, current, i_amp, i_phase, plot=plot)
+            cross_check_estimate(x_data, voltage, v_amp, v_phase, plot=plot)
+    elif estimator == 'joint':
+        ratio, shift, ratio_error, shift_error, fit = joint_fit(
+            x_data, current, voltage, freq
+        )
+        i_amp = fit.x[0]
+        i_phase = fit.x[1]
+        if i_amp < 0:
+            # Equivalent solution with the current phase rotated by pi
+            i_amp = -1 * i_amp
+            i_phase = i_phase + np.pi
+        i_phase = i_phase % (2 * np.pi)
+        v_amp = ratio * i_amp
+        v_phase = i_phase - shift
+    else:
+        raise ValueError('Unknown estimator: {}'.format(estimator))
 
     phase_shift = i_phase - v_phase
     # NOTICE!!! 1000ohm is assumed as shunt!!!!!
     impedance = 1000 * v_amp / i_amp
+    if estimator == 'joint':
+        impedance_error = 1000 * ratio_error
+        phase_error = shift_error
+        msg = "Uncertainty |Z|: {:.2f}ohm. Phase-shift: {:.4f}"
+        print(msg.format(impedance_error, phase_error))
+    else:
+        impedance_error = np.nan
+        phase_error = np.nan
 
     msg = "I: {:.2f}mA.  V: {:.2f}V. |Z|: {:.2f}ohm"
     print(msg.format(1000 * i_amp / 1000, v_amp, 1000 * v_amp / i_amp))
@@ -184,32 +563,210 @@ def test_a_frequency(freq):
     print(msg.format(i_phase, v_phase, phase_shift))
 
     # plot_data(x_data, current, voltage, 'Current', 'Voltage')
-    plot_data(
-        x_data,
-        sine_fit_func(fit_i.x, x_data, freq),
-        sine_fit_func(fit_v.x, x_data, freq),
-        'Current',
-        'Voltage',
-    )
+    if plot:
+        plot_data(
+            x_data,
+            sine_fit_func([i_amp, i_phase], x_data, freq),
+            sine_fit_func([v_amp, v_phase], x_data, freq),
+            'Current',
+            'Voltage',
+        )
+
+    return impedance, phase_shift, impedance_error, phase_error
 
-    return impedance, phase_shift
 
+def perform_a_sweep(estimator='fit', adaptive=False, archive=None, **kwargs):
+    """
+    Measure the impedance from 100 to 10000 rad/s. Either at 30 fixed
+    frequencies or, with adaptive, at frequencies chosen by
+    perform_adaptive_sweep (extra keyword arguments are passed on).
+    """
+    if adaptive:
+        results = perform_adaptive_sweep(estimator, archive=archive, **kwargs)
+    else:
+        results = {}
+        for freq in np.logspace(2, 4, num=30):
+            print("Testing: {}".format(freq))
+            results[freq] = test_a_frequency(freq, estimator, archive=archive)
+
+    write_results(results)
+    if RENDER_MODE == 'deferred':
+        render_deferred()
+
+
+def refinement_scores(results, phase_tolerance, impedance_tolerance):
+    """
+    For each interval between neighbouring frequencies, the change in
+    phase and in log|Z| relative to the tolerances. Returns the sorted
+    frequencies and the largest of the two relative changes per interval.
+    """
+    freqs = np.array(sorted(results))
+    impedance = np.array([results[freq][0] for freq in freqs])
+    phase = np.array([results[freq][1] for freq in freqs])
+    # Wrap the phase difference to +-pi
+    d_phase = np.abs(np.angle(np.exp(1j * np.diff(phase))))
+    d_impedance = np.abs(np.diff(np.log(impedance)))
+    scores = np.maximum(d_phase / phase_tolerance, d_impedance / impedance_tolerance)
+    return freqs, scores
+
+
+def perform_adaptive_sweep(
+    estimator='fit',
+    coarse_points=7,
+    max_points=30,
+    phase_tolerance=0.05,
+    impedance_tolerance=0.05,
+    min_ratio=1.01,
+    archive=None,
+):
+    """
+    Start from a coarse logarithmic grid and keep adding the geometric
+    mid-point of the interval where phase or |Z| changes the most, until
+    all neighbours agree within phase_tolerance (rad) and
+    impedance_tolerance (relative) or max_points have been measured.
+    Intervals narrower than a factor min_ratio are not split further.
+    """
+    results = {}
+    for freq in np.logspace(2, 4, num=coarse_points):
+        print("Testing: {}".format(freq))
+        results[freq] = test_a_frequency(freq, estimator, archive=archive)
 
-def perform_a_sweep():
+    while len(results) < max_points:
+        freqs, scores = refinement_scores(results, phase_tolerance, impedance_tolerance)
+        scores[freqs[1:] / freqs[:-1] < min_ratio] = 0
+        worst = np.argmax(scores)
+        if scores[worst] <= 1:
+            break
+        freq = np.sqrt(freqs[worst] * freqs[worst + 1])
+        print("Refining: {}".format(freq))
+        results[freq] = test_a_frequency(freq, estimator, archive=archive)
+    print('Adaptive sweep done after {} points'.format(len(results)))
+    return dict(sorted(results.items()))
+
+
+def _timed_analysis(freq, x_data, data, estimator):
+    t = time.perf_counter()
+    values = analyse_a_frequency(freq, x_data, data, estimator, plot=False)
+    return values, time.perf_counter() - t
+
+
+def perform_pipelined_sweep(
+    estimator='fit', workers=None, filename='results.csv', archive=None
+):
+    """
+    Same sweep as perform_a_sweep, but the analysis of frequency N runs in
+    a process pool while frequency N+1 is set and acquired. Results are
+    written to the results file in frequency order as soon as they are
+    ready. Returns the results and the accumulated time of each stage.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    timings = {'set_frequency': 0, 'acquire': 0, 'analysis': 0, 'wait': 0}
     results = {}
-    for freq in np.logspace(2, 4, num=30):
+    pending = collections.deque()
+
+    datafile = open(filename, 'w', newline='\n')
+    datawriter = csv.writer(datafile, delimiter=';')
+
+    def write_finished(block):
+        while pending and (block or pending[0][1].done()):
+            freq, future = pending.popleft()
+            t = time.perf_counter()
+            values, analysis_time = future.result()
+            timings['wait'] += time.perf_counter() - t
+            timings['analysis'] += analysis_time
+            results[freq] = values
+            datawriter.writerow([freq] + list(values))
+            datafile.flush()
+
+    t_start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for freq in np.logspace(2, 4, num=30):
+            print("Testing: {}".format(freq))
+            t = time.perf_counter()
+            set_frequency(freq)
+            timings['set_frequency'] += time.perf_counter() - t
+
+            t = time.perf_counter()
+            x_data, data = read_data(freq)
+            timings['acquire'] += time.perf_counter() - t
+            if archive is not None:
+                archive.append(data, sample_rate, freq=freq)
+
+            # data is a view into the acquisition buffer, the worker gets a copy
+            future = pool.submit(_timed_analysis, freq, x_data, data.copy(), estimator)
+            pending.append((freq, future))
+            write_finished(block=False)
+        write_finished(block=True)
+    datafile.close()
+    total = time.perf_counter() - t_start
+
+    points = len(results)
+    msg = '{:<14} total: {:7.2f}s  per point: {:7.1f}ms'
+    for stage, duration in timings.items():
+        print(msg.format(stage, duration, 1000 * duration / points))
+    print('Wall time: {:.2f}s, {:.2f} points/s'.format(total, points / total))
+    hardware_time = timings['set_frequency'] + timings['acquire']
+    if hardware_time > timings['analysis'] / workers:
+        print('Sweep is acquisition-bound')
+    else:
+        print('Sweep is compute-bound')
+    return results, timings
+
+
+def _read_copy(freq):
+    x_data, data = read_data(freq)
+    # data is a view into the acquisition buffer
+    return x_data, data.copy()
+
+
+async def perform_async_sweep(estimator='lockin', filename='results.csv', archive=None):
+    """
+    Same sweep as perform_a_sweep, but the AWG and the DAQ are used from
+    asyncio and the analysis of each frequency runs in a worker thread
+    while the next frequency is set and acquired.
+    Run with asyncio.run(perform_async_sweep()).
+    """
+    awg = AsyncInstrument(name='awg')
+    daq = AsyncInstrument(name='daq')
+    freqs = np.logspace(2, 4, num=30)
+    analyses = []
+    for freq in freqs:
         print("Testing: {}".format(freq))
-        impedance, phase_shift = test_a_frequency(freq)
-        results[freq] = (impedance, phase_shift)
+        # The acquisition must not start before the frequency is set
+        async with ordered(awg, daq):
+            await awg.run(set_frequency, freq)
+            x_data, data = await daq.run(_read_copy, freq)
+        if archive is not None:
+            archive.append(data, sample_rate, freq=freq)
+        analysis = asyncio.to_thread(
+            analyse_a_frequency, freq, x_data, data, estimator, False, False
+        )
+        analyses.append(asyncio.ensure_future(analysis))
+    values = await asyncio.gather(*analyses)
+    results = dict(zip(freqs, values))
+    write_results(results, filename)
+    return results
+
 
-    filename = 'results.csv'
+def write_results(results, filename='results.csv'):
     datafile = open(filename, 'w', newline='\n')
     datawriter = csv.writer(datafile, delimiter=';')
     for freq, values in results.items():
-        datawriter.writerow([freq, values[0], values[1]])
+        # freq; |Z|; phase shift; |Z| uncertainty; phase shift uncertainty
+        datawriter.writerow([freq] + list(values))
     datafile.flush()
 
 
 if __name__ == "__main__":
+    # Record the instrument I/O, see common.tracing
+    # tracing.enable("trace.json")
+    # RENDER_MODE = 'headless'
     # test_a_frequency(4000)
+    # test_a_frequency(4000, estimator='lockin', cross_check=True)
     perform_a_sweep()
+    # perform_a_sweep(estimator='lockin')
+    # perform_a_sweep(estimator='joint')
+    # perform_a_sweep(estimator='lockin', adaptive=True, max_points=20)
+    # perform_pipelined_sweep(estimator='fit')
+    # asyncio.run(perform_async_sweep(estimator='lockin'))
@@ -0,0 +1,208 @@
+import math
+import time
+
+import numpy as np
+
+import impedance_spectroscopy as imp
+
+# Number of points in the arbitrary waveform uploaded to the AWG
+AWG_POINTS = 2**14
+
+
+def multisine_grid(freqs, resolution=16):
+    """
+    Place the wanted (angular) frequencies on the harmonics of a common
+    base frequency. The base frequency is chosen so that one period is
+    an integer number of DAQ samples, and so that the lowest frequency
+    is at least `resolution` harmonics.
+    Returns samples per period and the (unique, sorted) harmonic numbers.
+    """
+    lowest = min(freqs) / (2 * math.pi)
+    period_samples = int(round(imp.sample_rate * resolution / lowest))
+    base_freq = imp.sample_rate / period_samples
+    harmonics = np.unique(np.round(np.asarray(freqs) / (2 * math.pi * base_freq)))
+    harmonics = harmonics[harmonics > 0].astype(int)
+    return period_samples, harmonics
+
+
+def multisine(harmonics, points, phases):
+    """
+    One period of a multisine with equal amplitude on the given harmonics,
+    normalised to a peak value of 1.
+    """
+    spectrum = np.zeros(points // 2 + 1, dtype=complex)
+    spectrum[harmonics] = np.exp(1j * phases)
+    waveform = np.fft.irfft(spectrum, n=points)
+    return waveform / np.max(np.abs(waveform))
+
+
+def crest_factor(waveform):
+    return np.max(np.abs(waveform)) / np.sqrt(np.mean(waveform**2))
+
+
+def schroeder_phases(harmonics):
+    """
+    Schroeder phases, a good starting point for a low crest factor.
+    """
+    n = np.arange(len(harmonics))
+    return -1 * np.pi * n * (n + 1) / len(harmonics)
+
+
+def optimise_phases(harmonics, points=AWG_POINTS, iterations=200):
+    """
+    Lower the crest factor by iterative clipping: clip the peaks of the
+    time signal, keep the resulting phases and restore the amplitudes.
+    Starts from the Schroeder phases and returns the best phases seen.
+    """
+    phases = schroeder_phases(harmonics)
+    best_phases = phases
+    best_crest = crest_factor(multisine(harmonics, points, phases))
+    for _ in range(iterations):
+        waveform = multisine(harmonics, points, phases)
+        crest = crest_factor(waveform)
+        if crest < best_crest:
+            best_crest = crest
+            best_phases = phases
+        clip_level = 0.9 * np.max(np.abs(waveform))
+        clipped = np.clip(waveform, -1 * clip_level, clip_level)
+        phases = np.angle(np.fft.rfft(clipped)[harmonics])
+    return best_phases, best_crest
+
+
+def upload_multisine(waveform, base_freq, amplitude):
+    """
+    Upload one period of the waveform (values between -1 and 1) to the
+    AWG as an arbitrary waveform and play it continuously.
+    amplitude is peak-peak voltage of the full waveform.
+    """
+    if imp.BACKEND is not None:
+        imp.BACKEND.upload_waveform(waveform, base_freq, amplitude)
+        return
+    awg = imp.open_awg()
+    # The waveform in use cannot be cleared, switch away from it first
+    awg.write('SOURCE1:FUNCTION SINUSOID')
+    awg.write('SOURCE1:DATA:VOLATILE:CLEAR')
+    awg.write_ascii_values('SOURCE1:DATA:ARBITRARY MULTISINE, ', waveform)
+    awg.write('SOURCE1:FUNCTION:ARBITRARY MULTISINE')
+    awg.write('SOURCE1:FUNCTION ARB')
+    awg.write('SOURCE1:FUNCTION:ARBITRARY:SRATE {}'.format(base_freq * len(waveform)))
+    awg.write('SOURCE1:VOLTAGE {}'.format(amplitude))
+    awg.write('SOURCE1:VOLTAGE:OFFSET 0')
+
+
+def sine_settings():
+    """
+    Amplitude and offset of the sine on channel 1, to be restored with
+    restore_sine() after the multisine.
+    """
+    if imp.BACKEND is not None:
+        return None
+    awg = imp.open_awg()
+    return {
+        'VOLTAGE': float(awg.query('SOURCE1:VOLTAGE?')),
+        'VOLTAGE:OFFSET': float(awg.query('SOURCE1:VOLTAGE:OFFSET?')),
+    }
+
+
+def restore_sine(settings):
+    """
+    Switch channel 1 back to the sine used by the single frequency sweeps.
+    """
+    if settings is None:
+        return
+    awg = imp.open_awg()
+    awg.write('SOURCE1:FUNCTION SINUSOID')
+    for setting, value in settings.items():
+        awg.write('SOURCE1:{} {}'.format(setting, value))
+
+
+def extract_spectrum(data, period_samples, harmonics):
+    """
+    Cross-spectrum of the two channels, averaged over all full periods
+    in the record. Returns |Z|, phase shift (current phase - voltage
+    phase) and the standard error of both from the spread between periods.
+    """
+    data = np.asarray(data)
+    periods = data.shape[1] // period_samples
+    record = data[:, : periods * period_samples].reshape(2, periods, period_samples)
+    spectra = np.fft.rfft(record, axis=2)[:, :, harmonics]
+    current = spectra[0]
+    voltage = spectra[1]
+
+    transfer = np.sum(voltage * np.conj(current), axis=0)
+    transfer = transfer / np.sum(np.abs(current) ** 2, axis=0)
+    # NOTICE!!! 1000ohm is assumed as shunt!!!!!
+    impedance = 1000 * np.abs(transfer)
+    phase_shift = -1 * np.angle(transfer)
+
+    if periods > 1:
+        per_period = voltage / current
+        impedance_error = 1000 * np.std(np.abs(per_period), axis=0, ddof=1)
+        phase_error = np.std(np.angle(per_period / transfer), axis=0, ddof=1)
+        impedance_error = impedance_error / np.sqrt(periods)
+        phase_error = phase_error / np.sqrt(periods)
+    else:
+        impedance_error = np.full(len(harmonics), np.nan)
+        phase_error = np.full(len(harmonics), np.nan)
+    return impedance, phase_shift, impedance_error, phase_error
+
+
+def perform_broadband_sweep(
+    freqs=None,
+    periods=4,
+    amplitude=1.0,
+    settle_periods=1,
+    filename='results.csv',
+    archive=None,
+):
+    """
+    Measure the whole spectrum in a single acquisition: the AWG plays a
+    multisine with all wanted frequencies and the impedance at each of
+    them is extracted from one long record.
+    The frequencies are rounded to the nearest harmonic of the multisine,
+    the actual frequencies are written to the results file.
+    The AWG is switched back to the previous sine afterwards.
+    """
+    if freqs is None:
+        freqs = np.logspace(2, 4, num=30)
+    period_samples, harmonics = multisine_grid(freqs)
+    base_freq = imp.sample_rate / period_samples
+    if 2 * max(harmonics) >= AWG_POINTS:
+        raise ValueError('Too many harmonics for {} AWG points'.format(AWG_POINTS))
+
+    phases, crest = optimise_phases(harmonics)
+    print('{} tones, crest factor: {:.2f}'.format(len(harmonics), crest))
+    sine = sine_settings()
+    try:
+        waveform = multisine(harmonics, AWG_POINTS, phases)
+        upload_multisine(waveform, base_freq, amplitude)
+        time.sleep(settle_periods / base_freq)
+        data = imp.acquire(periods * period_samples)
+    finally:
+        restore_sine(sine)
+    if archive is not None:
+        archive.append(
+            data,
+            imp.sample_rate,
+            mode='multisine',
+            period_samples=period_samples,
+            harmonics=harmonics.tolist(),
+        )
+    impedance, phase_shift, impedance_error, phase_error = extract_spectrum(
+        data, period_samples, harmonics
+    )
+
+    results = {}
+    for i, harmonic in enumerate(harmonics):
+        freq = 2 * math.pi * base_freq * harmonic
+        results[freq] = (
+            impedance[i], phase_shift[i], impedance_error[i], phase_error[i]
+        )
+        msg = 'Freq: {:.1f}. |Z|: {:.2f}ohm. Phase-shift: {:.2f}'
+        print(msg.format(freq, impedance[i], phase_shift[i]))
+    imp.write_results(results, filename)
+    return results
+
+
+if __name__ == '__main__':
+    perform_broadband_sweep()
@@ -1,27 +1,31 @@
-import csv
+import sys
+import pathlib
 
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+
+
+def normalise_phase(phase_shift):
+    """
+    Bring the measured phase shift into the expected range: negative
+    values are moved up by 2pi, values above pi/4 are moved down by pi/2.
+    """
+    phase_shift = np.asarray(phase_shift)
+    phase_shift = np.where(phase_shift < 0, phase_shift + 2 * np.pi, phase_shift)
+    too_high = phase_shift > np.pi / 4
+    phase_shift = np.where(too_high, phase_shift - np.pi / 2, phase_shift)
+    return phase_shift
 
 
 def plot_results(results):
-    frequency = []
-    shift = []
-    real = []
-    imaginary = []
-    for freq, val in results.items():
-        frequency.append(freq)
-        phase_shift = val[1]  # % np.pi
-        print('{:.3f} '.format(phase_shift / np.pi), end='')
-        # print(phase_shift, np.pi / 2)
-        if phase_shift < 0:
-            phase_shift += 2* np.pi
-        if phase_shift > np.pi / 4:
-            phase_shift = phase_shift - (np.pi / 2)
-        print('{:.3f}'.format(phase_shift / np.pi))
-        shift.append(phase_shift)
-        real.append(val[0] * np.cos(phase_shift))
-        imaginary.append(val[0] * np.sin(phase_shift))
+    frequency = np.array(list(results.keys()))
+    values = np.array(list(results.values()))
+    shift = normalise_phase(values[:, 1])
+    for raw, normalised in zip(values[:, 1], shift):
+        print('{:.3f} {:.3f}'.format(raw / np.pi, normalised / np.pi))
+    real = values[:, 0] * np.cos(shift)
+    imaginary = values[:, 0] * np.sin(shift)
 
     fig = plt.figure()
     fig.set_size_inches(20, 10)
@@ -39,17 +43,139 @@ def plot_results(results):
     plt.show()
 
 
-def load_data():
+def load_results(filename='results.csv'):
+    """
+    Read a results file in one pass. Returns arrays of frequency, |Z|
+    and phase shift.
+    """
+    data = np.loadtxt(filename, delimiter=';', usecols=(0, 1, 2), ndmin=2)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+
+def load_data(filename='results.csv'):
     results = {}
-    with open('results.csv', 'r', newline='\n') as csvfile:
-        reader = csv.reader(csvfile, delimiter=';')
-        for row in reader:
-            freq = float(row[0])
-            results[freq] = (float(row[1]), float(row[2]))
+    for freq, impedance, phase_shift in zip(*load_results(filename)):
+        results[freq] = (impedance, phase_shift)
     return results
 
 
+def summary_statistics(runs, points=50):
+    """
+    Mean, standard deviation, min and max of |Z| and phase shift over all
+    runs. If the runs do not share a frequency grid, they are interpolated
+    (in log frequency) onto a common grid within the overlapping range.
+    """
+    grids = [run[0] for run in runs]
+    same_grid = all(
+        len(grid) == len(grids[0]) and np.allclose(grid, grids[0]) for grid in grids
+    )
+    if same_grid:
+        freq = grids[0]
+        impedance = np.array([run[1] for run in runs])
+        phase = np.array([run[2] for run in runs])
+    else:
+        low = max(grid.min() for grid in grids)
+        high = min(grid.max() for grid in grids)
+        freq = np.logspace(np.log10(low), np.log10(high), points)
+        impedance = []
+        phase = []
+        for run_freq, run_impedance, run_phase in runs:
+            order = np.argsort(run_freq)
+            log_freq = np.log(run_freq[order])
+            impedance.append(np.interp(np.log(freq), log_freq, run_impedance[order]))
+            phase.append(np.interp(np.log(freq), log_freq, run_phase[order]))
+        impedance = np.array(impedance)
+        phase = np.array(phase)
+
+    summary = [freq]
+    for values in (impedance, phase):
+        summary += [
+            values.mean(axis=0),
+            values.std(axis=0),
+            values.min(axis=0),
+            values.max(axis=0),
+        ]
+    return np.column_stack(summary)
+
+
+def plot_batch(directory, pattern='results*.csv', output_dir='batch_plots'):
+    """
+    Load all result files in a directory and write a Bode/Nyquist figure
+    for each run, an overlay of all runs and a summary.csv with
+    statistics per frequency. A single figure object is reused for all
+    figures. Files that are not result files are skipped.
+    """
+    output = pathlib.Path(output_dir)
+    output.mkdir(parents=True, exist_ok=True)
+
+    files = []
+    runs = []
+    for filename in sorted(pathlib.Path(directory).glob(pattern)):
+        try:
+            freq, impedance, phase_shift = load_results(filename)
+        except (ValueError, IndexError) as e:
+            print('Skipping {}: {}'.format(filename, e))
+            continue
+        files.append(filename)
+        runs.append((freq, impedance, normalise_phase(phase_shift)))
+    if not runs:
+        print('No result files in {}'.format(directory))
+        return
+
+    fig = Figure()
+    fig.set_size_inches(20, 10)
+    ax_abs = fig.add_subplot(2, 2, 1)
+    ax_phase = fig.add_subplot(2, 2, 3, sharex=ax_abs)
+    ax_nyquist = fig.add_subplot(1, 2, 2)
+
+    def setup_axes():
+        ax_abs.set_xscale('log')
+        ax_abs.set_yscale('log')
+        ax_abs.set_ylabel('|Z| / ohm')
+        ax_phase.set_xlabel('Angular frequency')
+        ax_phase.set_ylabel('Phase shift / rad')
+        ax_nyquist.set_xlabel('Real')
+        ax_nyquist.set_ylabel('Imaginary')
+
+    # One figure per run, only the data of the lines is replaced
+    setup_axes()
+    (abs_line,) = ax_abs.plot([], [], 'bo-')
+    (phase_line,) = ax_phase.plot([], [], 'bo-')
+    (nyquist_line,) = ax_nyquist.plot([], [], 'bo-')
+    for filename, (freq, impedance, phase) in zip(files, runs):
+        abs_line.set_data(freq, impedance)
+        phase_line.set_data(freq, phase)
+        nyquist_line.set_data(impedance * np.cos(phase), impedance * np.sin(phase))
+        for axis in (ax_abs, ax_phase, ax_nyquist):
+            axis.relim()
+            axis.autoscale_view()
+        fig.suptitle(filename.name)
+        fig.savefig(output / (filename.stem + '.png'))
+
+    # Overlay of all runs in the same figure
+    for axis in (ax_abs, ax_phase, ax_nyquist):
+        axis.clear()
+    setup_axes()
+    for freq, impedance, phase in runs:
+        real = impedance * np.cos(phase)
+        imaginary = impedance * np.sin(phase)
+        ax_abs.plot(freq, impedance, '-', alpha=0.5)
+        ax_phase.plot(freq, phase, '-', alpha=0.5)
+        ax_nyquist.plot(real, imaginary, '-', alpha=0.5)
+    fig.suptitle('{} runs'.format(len(runs)))
+    fig.savefig(output / 'overlay.png')
+
+    summary = summary_statistics(runs)
+    header = 'freq;z_mean;z_std;z_min;z_max;phase_mean;phase_std;phase_min;phase_max'
+    np.savetxt(output / 'summary.csv', summary, delimiter=';', header=header)
+    print('{} runs written to {}'.format(len(runs), output))
+
+
 if __name__ == '__main__':
-    results = load_data()
-    # print(results)
-    plot_results(results)
+    if len(sys.argv) > 1:
+        # python plot.py <directory with result files>
+        plot_batch(sys.argv[1])
+    else:
+        results = load_data()
+        # print(results)
+        plot_results(results)
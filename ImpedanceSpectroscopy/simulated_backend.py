@@ -0,0 +1,137 @@
+import time
+
+import numpy as np
+
+import impedance_spectroscopy as imp
+
+
+def resistor(r=1000):
+    def impedance(omega):
+        return r * np.ones_like(omega, dtype=complex)
+
+    return impedance
+
+
+def rc_series(r=1000, c=1e-6):
+    def impedance(omega):
+        return r + 1 / (1j * omega * c)
+
+    return impedance
+
+
+def rc_parallel(r=1000, c=1e-6):
+    def impedance(omega):
+        return r / (1 + 1j * omega * r * c)
+
+    return impedance
+
+
+def randles(r_s=100, r_ct=1000, c_dl=1e-6, sigma=500):
+    """
+    Solution resistance in series with the double layer capacitance in
+    parallel with charge transfer resistance and Warburg diffusion.
+    """
+
+    def impedance(omega):
+        warburg = sigma * (1 - 1j) / np.sqrt(omega)
+        faradaic = r_ct + warburg
+        return r_s + faradaic / (1 + 1j * omega * c_dl * faradaic)
+
+    return impedance
+
+
+CIRCUITS = {
+    'R': resistor,
+    'RC': rc_parallel,
+    'series_RC': rc_series,
+    'randles': randles,
+}
+
+
+class SimulatedBackend:
+    """
+    Replaces the AWG and the DAQ with a circuit model. The AWG drives the
+    shunt and the device under test in series through its output
+    resistance, channel 0 is the voltage over the shunt and channel 1 the
+    voltage over the device, both with gaussian noise.
+    set_latency is the time to reprogram the AWG and time_scale scales
+    the duration of an acquisition relative to real time (0 is instant).
+    """
+
+    def __init__(
+        self,
+        circuit='RC',
+        amplitude=1.0,
+        r_shunt=1000,
+        r_output=50,
+        noise=1e-3,
+        set_latency=0.1,
+        acquire_latency=0.01,
+        time_scale=0,
+        seed=None,
+        **circuit_params
+    ):
+        if isinstance(circuit, str):
+            circuit = CIRCUITS[circuit](**circuit_params)
+        self.impedance = circuit
+        self.amplitude = amplitude
+        self.r_shunt = r_shunt
+        self.r_output = r_output
+        self.noise = noise
+        self.set_latency = set_latency
+        self.acquire_latency = acquire_latency
+        self.time_scale = time_scale
+        self.rng = np.random.default_rng(seed)
+        self.timings = {'set_frequency': [], 'acquire': []}
+        # The excitation as lists of angular frequencies and complex amplitudes
+        self.tones = np.array([])
+        self.phasors = np.array([])
+
+    def set_frequency(self, freq):
+        t = time.perf_counter()
+        self.tones = np.array([freq])
+        self.phasors = np.array([self.amplitude + 0j])
+        time.sleep(self.set_latency)
+        self.timings['set_frequency'].append(time.perf_counter() - t)
+
+    def upload_waveform(self, waveform, base_freq, amplitude):
+        t = time.perf_counter()
+        # Peak of the waveform is 1, amplitude is peak-peak
+        spectrum = 2 * np.fft.rfft(waveform) / len(waveform) * amplitude / 2
+        harmonics = np.flatnonzero(np.abs(spectrum) > 1e-9 * np.max(np.abs(spectrum)))
+        harmonics = harmonics[harmonics > 0]
+        self.tones = 2 * np.pi * base_freq * harmonics
+        # rfft gives the phase of a cosine, the model uses sine
+        self.phasors = spectrum[harmonics] * 1j
+        time.sleep(self.set_latency)
+        self.timings['set_frequency'].append(time.perf_counter() - t)
+
+    def acquire(self, samples):
+        t = time.perf_counter()
+        # The acquisition is not synchronised to the AWG
+        start = self.rng.uniform(0, 1)
+        x = start + np.arange(samples) / imp.sample_rate
+        z_dut = self.impedance(self.tones)
+        currents = self.phasors / (self.r_output + self.r_shunt + z_dut)
+
+        data = np.zeros((2, samples))
+        for omega, current, z in zip(self.tones, currents, z_dut):
+            excitation = np.exp(1j * omega * x)
+            data[0] += np.imag(current * self.r_shunt * excitation)
+            data[1] += np.imag(current * z * excitation)
+        data += self.rng.normal(0, self.noise, data.shape)
+
+        elapsed = time.perf_counter() - t
+        wait = self.acquire_latency + self.time_scale * samples / imp.sample_rate
+        time.sleep(max(wait - elapsed, 0))
+        self.timings['acquire'].append(time.perf_counter() - t)
+        return data
+
+
+def use_simulated_backend(circuit='RC', **kwargs):
+    """
+    Create a SimulatedBackend and make impedance_spectroscopy use it.
+    """
+    backend = SimulatedBackend(circuit, **kwargs)
+    imp.use_backend(backend)
+    return backend
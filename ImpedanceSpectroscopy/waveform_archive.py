@@ -0,0 +1,128 @@
+import json
+import time
+import pathlib
+import argparse
+import concurrent.futures
+
+import numpy as np
+
+import multisine
+import impedance_spectroscopy as imp
+
+
+class WaveformArchive:
+    """
+    Stores the raw two-channel waveforms of every acquisition in a
+    directory. Each acquisition is one chunk: a .npy file (which can be
+    memory mapped) or, with compress, a compressed .npz file. The file
+    index.json holds frequency, sample rate and other metadata.
+    """
+
+    def __init__(self, path, compress=False, dtype='float32'):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.compress = compress
+        self.dtype = dtype
+        self.index_file = self.path / 'index.json'
+        if self.index_file.exists():
+            self.entries = json.loads(self.index_file.read_text())
+        else:
+            self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, data, sample_rate, freq=None, **metadata):
+        """
+        Store an acquisition. data has shape (channels, samples), metadata
+        must be json-serialisable.
+        """
+        data = np.asarray(data, dtype=self.dtype)
+        name = 'record_{:05d}'.format(len(self.entries))
+        if self.compress:
+            filename = name + '.npz'
+            np.savez_compressed(self.path / filename, data=data)
+        else:
+            filename = name + '.npy'
+            np.save(self.path / filename, data)
+
+        entry = {
+            'file': filename,
+            'freq': freq,
+            'sample_rate': sample_rate,
+            'shape': data.shape,
+            'time': time.time(),
+        }
+        entry.update(metadata)
+        self.entries.append(entry)
+        self.index_file.write_text(json.dumps(self.entries, indent=1))
+
+    def load(self, index):
+        """
+        Return the metadata and the data of an acquisition. Uncompressed
+        data is memory mapped and only read from disk when used.
+        """
+        entry = self.entries[index]
+        filename = self.path / entry['file']
+        if filename.suffix == '.npz':
+            with np.load(filename) as npz:
+                data = npz['data']
+        else:
+            data = np.load(filename, mmap_mode='r')
+        return entry, data
+
+
+def analyse_record(path, index, estimator='fit'):
+    """
+    Rerun the analysis of a single archived acquisition. Returns a dict
+    of frequency: (|Z|, phase shift, |Z| uncertainty, phase uncertainty).
+    """
+    entry, data = WaveformArchive(path).load(index)
+    if entry.get('mode') == 'multisine':
+        period_samples = entry['period_samples']
+        harmonics = np.array(entry['harmonics'])
+        values = multisine.extract_spectrum(data, period_samples, harmonics)
+        base_freq = entry['sample_rate'] / period_samples
+        freqs = 2 * np.pi * base_freq * harmonics
+        return dict(zip(freqs, zip(*values)))
+
+    freq = entry['freq']
+    x_data = np.arange(1, data.shape[1] + 1) / entry['sample_rate']
+    values = imp.analyse_a_frequency(
+        freq, x_data, data, estimator, plot=False, rate=entry['sample_rate']
+    )
+    return {freq: values}
+
+
+def replay(path, estimator='fit', workers=None, filename=None):
+    """
+    Analyse every acquisition in an archive in parallel. Each worker
+    memory maps its own records, so no waveform data is sent between
+    processes. Results are written to filename, if given.
+    """
+    archive = WaveformArchive(path)
+    t = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(analyse_record, path, index, estimator)
+            for index in range(len(archive))
+        ]
+        results = {}
+        for future in futures:
+            results.update(future.result())
+    results = dict(sorted(results.items()))
+    msg = 'Replayed {} acquisitions in {:.2f}s'
+    print(msg.format(len(archive), time.perf_counter() - t))
+    if filename is not None:
+        imp.write_results(results, filename)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay an archived sweep')
+    parser.add_argument('path', help='Archive directory')
+    parser.add_argument('--estimator', default='fit', help='fit, lockin or joint')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default='replay.csv', help='Results file')
+    args = parser.parse_args()
+    replay(args.path, args.estimator, args.workers, args.output)
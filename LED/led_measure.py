@@ -1,10 +1,15 @@
-import csv
+import sys
 import time
-import datetime
+import pathlib
 
 import pyvisa
 import nidaqmx
 
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from common import tracing  # noqa: E402
+from common.data_writer import DataWriter  # noqa: E402
+from common.instrument_registry import get_instrument  # noqa: E402
+
 
 class PowerSupply:
     """
@@ -13,15 +18,17 @@ class PowerSupply:
     """
 
     def __init__(self, port='COM1'):
-        rm = pyvisa.ResourceManager()
-        self.comm = rm.open_resource('COM1')
-        self.comm.baud_rate = 2400
-        self.comm.stop_bits = pyvisa.constants.StopBits.one
-        self.comm.write_termination = '\r'
+        self.comm = get_instrument(port, configure=self._configure)
         self.max_voltage = 5
         self.voltage_setpoint = None  # Will be set to in next line
         self.set_voltage(0)
 
+    @staticmethod
+    def _configure(comm):
+        comm.baud_rate = 2400
+        comm.stop_bits = pyvisa.constants.StopBits.one
+        comm.write_termination = '\r'
+
     def status(self):
         # Apparantly this does not work, perhaps the cable
         # not crossed?
@@ -70,29 +77,6 @@ class PowerSupply:
         self.comm.write(cmd)
 
 
-class DataWriter:
-    """
-    This class provides a way to store two data-files with the same data. One
-    file is named with a unique name that ensure that no data is lost. The
-    other file is always called `led_plot.csv` and will be used by the plotting
-    programm.
-    """
-
-    def __init__(self):
-        now = datetime.datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
-        filename = 'data_' + now + '.csv'
-        self.liveplot = open('led_plot.csv', 'w', newline='\n')
-        self.datafile = open(filename, 'w', newline='\n')
-        self.livewriter = csv.writer(self.liveplot, delimiter=';')
-        self.datawriter = csv.writer(self.datafile, delimiter=';')
-
-    def write_line(self, **kwargs):
-        self.livewriter.writerow(kwargs.values())
-        self.datawriter.writerow(kwargs.values())
-        self.liveplot.flush()
-        self.datafile.flush()
-
-
 class DataReader:
     def __init__(self):
         self.shunt = 100  # ohm
@@ -112,7 +96,7 @@ class DataReader:
             dev = 'Dev1/ai3'
             config = nidaqmx.constants.TerminalConfiguration.DIFF
 
-        with nidaqmx.Task() as task:
+        with tracing.span('daq', dev) as span, nidaqmx.Task() as task:
             task.ai_channels.add_ai_voltage_chan(
                 dev,
                 terminal_config=config,
@@ -125,6 +109,7 @@ class DataReader:
                 samps_per_chan=self.samples,
             )
             data = task.read(number_of_samples_per_channel=(self.samples))
+            span['bytes_in'] = 8 * len(data)
         value = sum(data) / self.samples
         return value
 
@@ -146,17 +131,28 @@ class DataReader:
 
 
 class LEDSweeper:
-    def __init__(self):
+    """
+    settle is an optional SettleDetector for the current readings, used
+    instead of a fixed wait after each voltage step.
+    """
+
+    def __init__(self, settle=None):
         self.ps = PowerSupply()
         self.ps.set_voltage(0)
         self.reader = DataReader()
-        self.writer = DataWriter()
-        time.sleep(0.2)
+        self.writer = DataWriter('led_plot.csv')
+        self.settle = settle
         # Measure the offset at zero - this is typically
         # not very large and could be omitted
-        self.i_0 = self.reader.read_current()
+        self.i_0 = self._settled_current(0.2)
         self.t_start = time.time()
 
+    def _settled_current(self, wait):
+        if self.settle is None:
+            time.sleep(wait)
+            return self.reader.read_current()
+        return self.settle.wait(self.reader.read_current)
+
     def sweep(self, max_current=10):
         """
         Sweep from 0mA to a given max_current (in mA).
@@ -169,9 +165,8 @@ class LEDSweeper:
         while current < max_current:
             voltage += 0.01
             self.ps.set_voltage(voltage)
-            time.sleep(0.1)
+            current = self._settled_current(0.1) - self.i_0
             dt = time.time() - self.t_start
-            current = self.reader.read_current() - self.i_0
             led_voltage = self.reader.read_voltage()
             msg = 'PS: {:.3f}V, I={:.3f}mA, V_LED={:.3f}V'
             print(msg.format(voltage, current, led_voltage))
@@ -185,5 +180,10 @@ class LEDSweeper:
 
 
 if __name__ == '__main__':
+    # Record the instrument I/O, see common.tracing
+    # tracing.enable('trace.json')
     sweep = LEDSweeper()
+    # from common.settle import SettleDetector
+    # sweep = LEDSweeper(settle=SettleDetector(0.01, relative=0.01))
     sweep.sweep(1)
+    # print(sweep.settle.summary())
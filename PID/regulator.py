@@ -1,26 +1,32 @@
-import csv
+import sys
 import time
 import pathlib
-import datetime
 import threading
 
 import pyvisa
 import nidaqmx
 
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from common import tracing  # noqa: E402
+from common.data_writer import DataWriter  # noqa: E402
+from common.instrument_registry import get_instrument  # noqa: E402
+
 CURRENT_LIMIT = 5
 
 
 class PowerSupply:
     def __init__(self, port='COM1'):
-        rm = pyvisa.ResourceManager()
-        self.comm = rm.open_resource('COM1')
-        self.comm.baud_rate = 2400
-        self.comm.stop_bits = pyvisa.constants.StopBits.one
-        self.comm.write_termination = '\r'
+        self.comm = get_instrument(port, configure=self._configure)
         self.max_voltage = 2
         self.voltage_setpoint = None  # Will be set to in next line
         self.set_voltage(0)
 
+    @staticmethod
+    def _configure(comm):
+        comm.baud_rate = 2400
+        comm.stop_bits = pyvisa.constants.StopBits.one
+        comm.write_termination = '\r'
+
     def status(self):
         # Apparantly this does not work, perhaps the cable
         # is not crossed?
@@ -101,7 +107,9 @@ class TemperatureReader(threading.Thread):
             while self.running:
                 time.sleep(0.25)
                 try:
-                    data = task.read(1, 10)
+                    with tracing.span('daq', 'SCC1Mod1/ai0') as span:
+                        data = task.read(1, 10)
+                        span['bytes_in'] = 8 * len(data)
                     self.temperature = data[0]
                     self.error = 0
                 except nidaqmx.errors.DaqReadError as e:
@@ -114,29 +122,6 @@ class TemperatureReader(threading.Thread):
                     self.temperature = 999
 
 
-class DataWriter:
-    """
-    This class provides a way to store two data-files with the same data. One
-    file is named with a unique name that ensure that no data is lost. The
-    other file is always called `pid_plot.csv` and will be used by the plotting
-    programm.
-    """
-
-    def __init__(self):
-        now = datetime.datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
-        filename = 'data_' + now + '.csv'
-        self.liveplot = open('pid_plot.csv', 'w', newline='\n')
-        self.datafile = open(filename, 'w', newline='\n')
-        self.livewriter = csv.writer(self.liveplot, delimiter=';')
-        self.datawriter = csv.writer(self.datafile, delimiter=';')
-
-    def write_line(self, **kwargs):
-        self.livewriter.writerow(kwargs.values())
-        self.datawriter.writerow(kwargs.values())
-        self.liveplot.flush()
-        self.datafile.flush()
-
-
 class Regulator:
     """
     Abstract regulator class.
@@ -147,7 +132,7 @@ class Regulator:
     """
 
     def __init__(self, max_voltage=8):
-        self.datawriter = DataWriter()
+        self.datawriter = DataWriter('pid_plot.csv')
         self.t_start = time.time()
         self.ps = PowerSupply()
         self.ps.set_max_voltage(max_voltage)
@@ -251,4 +236,6 @@ def run_regulator():
 
 
 if __name__ == '__main__':
+    # Record the instrument I/O, see common.tracing
+    # tracing.enable('trace.json')
     run_regulator()
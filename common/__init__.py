@@ -0,0 +1,3 @@
+"""
+Code shared between the exercises.
+"""
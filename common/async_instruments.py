@@ -0,0 +1,88 @@
+"""
+asyncio access to blocking instruments.
+
+pyvisa and nidaqmx calls block, AsyncInstrument runs them in a worker
+thread (asyncio.to_thread) so that calls to different instruments can
+overlap, eg. the DMM is armed while the AWG is still settling.
+
+Calls to the same instrument never overlap: each AsyncInstrument has a
+lock and its calls are done one at a time, in the order they were
+awaited. Operations on several instruments that must not be
+interleaved with other coroutines, eg. prepare a reading on the DMM,
+trigger it from the AWG and read it back, are done inside
+`async with ordered(awg, dmm):`. Waits that the measurement depends on
+(settle times) are explicit `await asyncio.sleep()` calls in the sweep.
+"""
+import asyncio
+import contextlib
+
+
+class AsyncInstrument:
+    """
+    instr is any object with blocking methods (a pyvisa session, a driver
+    class like Agilent34401a...), call() runs one of its methods. run()
+    runs any function under the lock of this instrument, eg. module
+    level functions that talk to the instrument.
+    """
+
+    def __init__(self, instr=None, name=None):
+        self.instr = instr
+        self.name = name
+        self._lock = None
+        self._owner = None
+
+    @property
+    def lock(self):
+        # Created on first use, inside the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @contextlib.asynccontextmanager
+    async def hold(self):
+        """
+        Exclusive use of the instrument. The task that holds it may use
+        it again (sequentially) without waiting for itself.
+        """
+        task = asyncio.current_task()
+        if self._owner is task:
+            yield
+            return
+        async with self.lock:
+            self._owner = task
+            try:
+                yield
+            finally:
+                self._owner = None
+
+    async def run(self, func, *args, **kwargs):
+        async with self.hold():
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def call(self, method, *args, **kwargs):
+        return await self.run(getattr(self.instr, method), *args, **kwargs)
+
+    async def write(self, cmd):
+        return await self.call('write', cmd)
+
+    async def query(self, cmd):
+        return await self.call('query', cmd)
+
+    async def read(self):
+        return await self.call('read')
+
+
+@contextlib.asynccontextmanager
+async def ordered(*instruments):
+    """
+    Hold several instruments for a sequence of operations that must not
+    be interleaved with other coroutines. The instruments are locked in
+    a fixed order, so two ordered() blocks cannot deadlock. Inside the
+    block the instruments must be used sequentially by the same task,
+    ie. not through asyncio.gather().
+    """
+    unique = {id(instrument): instrument for instrument in instruments}
+    async with contextlib.AsyncExitStack() as stack:
+        for key in sorted(unique):
+            await stack.enter_async_context(unique[key].hold())
+        yield
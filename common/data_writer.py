@@ -0,0 +1,184 @@
+"""
+Writing of measured data to disk in a background thread.
+
+Every row is stored in two files with the same data. One file is named
+with a unique name that ensure that no data is lost. The other file
+always has the same name (live_filename) and is used by the plotting
+programs.
+
+write_line() only hands the row to the writer thread and never waits
+for the disk. Rows go through a bounded queue; if the queue is full
+they are kept in an overflow list instead, so a slow disk costs
+memory rather than stalling a sweep or a regulator loop.
+"""
+import os
+import csv
+import time
+import queue
+import atexit
+import datetime
+import threading
+import collections
+
+
+class DataWriter:
+    """
+    Rows are written in batches, the files are flushed every
+    flush_interval seconds or every flush_rows rows, and synced to disk
+    when the writer is closed (at the latest when the program exits).
+    """
+
+    def __init__(
+        self,
+        live_filename='data.csv',
+        max_queue=1000,
+        flush_interval=0.5,
+        flush_rows=50,
+    ):
+        now = datetime.datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
+        filename = 'data_' + now + '.csv'
+        self.liveplot = open(live_filename, 'w', newline='\n')
+        self.datafile = open(filename, 'w', newline='\n')
+        self.livewriter = csv.writer(self.liveplot, delimiter=';')
+        self.datawriter = csv.writer(self.datafile, delimiter=';')
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._overflow = collections.deque()
+        self._closed = threading.Event()
+
+        self.rows_written = 0
+        self.batches = 0
+        self.overflows = 0
+        self.errors = 0
+        self.max_depth = 0
+        # Latest write and flush durations
+        self.write_times = collections.deque(maxlen=10000)
+        self.flush_times = collections.deque(maxlen=10000)
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write_line(self, **kwargs):
+        row = list(kwargs.values())
+        # Once rows are in the overflow, the following rows must go there
+        # too to keep the order
+        if self._overflow:
+            self._overflow.append(row)
+            self.overflows += 1
+        else:
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                self._overflow.append(row)
+                self.overflows += 1
+        self.max_depth = max(self.max_depth, self.queue_depth())
+
+    def queue_depth(self):
+        return self._queue.qsize() + len(self._overflow)
+
+    def _next_batch(self, wait=True):
+        rows = []
+        if wait:
+            try:
+                rows.append(self._queue.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        # The queue is empty, so everything in the overflow is newer
+        while self._overflow:
+            rows.append(self._overflow.popleft())
+        return rows
+
+    def _write(self, rows):
+        t = time.perf_counter()
+        self.datawriter.writerows(rows)
+        try:
+            self.livewriter.writerows(rows)
+        except OSError as e:
+            # The live file is only for plotting, do not retry
+            self.errors += 1
+            print('Live data file: {}'.format(e))
+        self.write_times.append(time.perf_counter() - t)
+        self.rows_written += len(rows)
+        self.batches += 1
+
+    def _flush(self):
+        t = time.perf_counter()
+        self.datafile.flush()
+        try:
+            self.liveplot.flush()
+        except OSError as e:
+            self.errors += 1
+            print('Live data file: {}'.format(e))
+        self.flush_times.append(time.perf_counter() - t)
+
+    def _run(self):
+        pending = []  # Rows not yet written to the data file
+        unflushed = 0
+        last_flush = time.perf_counter()
+        while True:
+            closing = self._closed.is_set()
+            pending += self._next_batch(wait=not closing)
+            try:
+                if pending:
+                    self._write(pending)
+                    unflushed += len(pending)
+                    pending = []
+                due = time.perf_counter() - last_flush > self.flush_interval
+                if unflushed and (closing or due or unflushed >= self.flush_rows):
+                    self._flush()
+                    unflushed = 0
+                    last_flush = time.perf_counter()
+            except OSError as e:
+                # Keep the rows and try again with the next batch
+                self.errors += 1
+                print('Data file: {}'.format(e))
+                if closing:
+                    return
+                time.sleep(self.flush_interval)
+            if closing and self.queue_depth() == 0:
+                return
+
+    def close(self):
+        """
+        Write all queued rows, sync the files to disk and close them.
+        """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._thread.join()
+        for datafile in (self.datafile, self.liveplot):
+            try:
+                datafile.flush()
+                os.fsync(datafile.fileno())
+            except OSError as e:
+                print('Unable to sync {}: {}'.format(datafile.name, e))
+            datafile.close()
+
+    def metrics(self):
+        """
+        Queue depth and latency of the writes to disk, times in seconds.
+        """
+
+        def mean(values):
+            return sum(values) / len(values) if values else 0
+
+        return {
+            'queue_depth': self.queue_depth(),
+            'max_queue_depth': self.max_depth,
+            'overflows': self.overflows,
+            'rows_written': self.rows_written,
+            'batches': self.batches,
+            'errors': self.errors,
+            'write_mean': mean(self.write_times),
+            'write_max': max(self.write_times, default=0),
+            'flush_mean': mean(self.flush_times),
+            'flush_max': max(self.flush_times, default=0),
+        }
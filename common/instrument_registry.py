@@ -0,0 +1,185 @@
+"""
+Shared handling of VISA instruments.
+
+The resource list is scanned once and every instrument is opened once;
+later requests for the same instrument get the same session back. All
+sessions are closed when the program exits.
+
+Addresses can be overridden, eg. to use simulated instruments (see
+common.scpi_simulator), with override_address() or the environment
+variable INSTRUMENT_ADDRESSES, eg.
+'ASRL1::INSTR=TCPIP::127.0.0.1::5025::SOCKET;USB0=...'. The name is the
+address or the `match` given by the scripts.
+"""
+import os
+import atexit
+
+import pyvisa
+
+from common import tracing
+
+# Errors raised by pyvisa, ignored when closing a session
+CONNECTION_ERRORS = (pyvisa.errors.VisaIOError, pyvisa.errors.InvalidSession)
+# VISA errors that indicate that the session is lost rather than an error
+# in the command itself. Timeouts are not among them, the instrument may
+# just be slow (eg. a reading waiting for a trigger)
+SESSION_LOST = (
+    pyvisa.constants.StatusCode.error_connection_lost,
+    pyvisa.constants.StatusCode.error_invalid_object,
+)
+
+
+def is_session_lost(error):
+    if isinstance(error, pyvisa.errors.InvalidSession):
+        return True
+    return getattr(error, 'error_code', None) in SESSION_LOST
+
+
+ADDRESS_OVERRIDES = dict(
+    item.split('=', 1)
+    for item in os.environ.get('INSTRUMENT_ADDRESSES', '').split(';')
+    if item.strip()
+)
+
+
+def override_address(name, address):
+    """
+    Use `address` for the instrument requested by the address or match
+    `name`.
+    """
+    ADDRESS_OVERRIDES[name] = address
+
+
+class InstrumentSession:
+    """
+    Wrapper around an open pyvisa resource. If a command fails because
+    the connection is lost, the resource is re-opened (and configured
+    again) and the command is retried once.
+    Attributes not defined here are passed on to the pyvisa resource.
+    """
+
+    _own_attributes = ('address', '_rm', '_configure', 'resource', 'reconnects')
+
+    def __init__(self, address, resource_manager, configure=None):
+        self.address = address
+        self._rm = resource_manager
+        self._configure = configure
+        self.resource = None
+        self.reconnects = 0
+        self._open()
+
+    def _open(self):
+        self.resource = self._rm.open_resource(self.address)
+        if self.address.endswith('::SOCKET'):
+            # Raw sockets have no end of message, use newlines
+            self.resource.read_termination = '\n'
+            self.resource.write_termination = '\n'
+        if self._configure is not None:
+            self._configure(self.resource)
+
+    def reconnect(self):
+        self.reconnects += 1
+        try:
+            self.resource.close()
+        except CONNECTION_ERRORS:
+            pass
+        self._open()
+
+    def _call(self, method, *args, **kwargs):
+        try:
+            return getattr(self.resource, method)(*args, **kwargs)
+        except CONNECTION_ERRORS as e:
+            if not is_session_lost(e):
+                raise
+            print('{}: {}, reconnecting'.format(self.address, e))
+            self.reconnect()
+            return getattr(self.resource, method)(*args, **kwargs)
+
+    def write(self, cmd):
+        return self._call('write', cmd)
+
+    def query(self, cmd):
+        return self._call('query', cmd)
+
+    def read(self):
+        return self._call('read')
+
+    def write_ascii_values(self, cmd, values):
+        return self._call('write_ascii_values', cmd, values)
+
+    def close(self):
+        self.resource.close()
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    def __setattr__(self, name, value):
+        if name in self._own_attributes:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.resource, name, value)
+
+
+class InstrumentRegistry:
+    def __init__(self):
+        self._rm = None
+        self._resources = None
+        self.sessions = {}
+
+    @property
+    def resource_manager(self):
+        if self._rm is None:
+            self._rm = pyvisa.ResourceManager()
+        return self._rm
+
+    def list_resources(self, refresh=False):
+        if self._resources is None or refresh:
+            self._resources = self.resource_manager.list_resources()
+        return self._resources
+
+    def find(self, match):
+        """
+        Return the first resource address that contains `match`.
+        """
+        for refresh in (False, True):
+            for address in self.list_resources(refresh=refresh):
+                if match in address:
+                    return address
+        raise LookupError('No instrument matching {}'.format(match))
+
+    def get(self, address=None, match=None, configure=None):
+        """
+        Return the session for an instrument, given either by its full
+        address or by a part of it. The instrument is opened (and
+        `configure` called with the new pyvisa resource) only the
+        first time it is requested. If tracing is enabled, the I/O of
+        the session is recorded (see common.tracing).
+        """
+        name = address if address is not None else match
+        if name in ADDRESS_OVERRIDES:
+            address = ADDRESS_OVERRIDES[name]
+        elif address is None:
+            address = self.find(match)
+        if address not in self.sessions:
+            session = InstrumentSession(address, self.resource_manager, configure)
+            self.sessions[address] = session
+        return tracing.traced(self.sessions[address], address)
+
+    def close_all(self):
+        for session in self.sessions.values():
+            try:
+                session.close()
+            except CONNECTION_ERRORS:
+                pass
+        self.sessions = {}
+        if self._rm is not None:
+            self._rm.close()
+            self._rm = None
+
+
+REGISTRY = InstrumentRegistry()
+atexit.register(REGISTRY.close_all)
+
+
+def get_instrument(address=None, match=None, configure=None):
+    return REGISTRY.get(address=address, match=match, configure=configure)
@@ -0,0 +1,224 @@
+"""
+Suppression of redundant SCPI commands.
+
+ScpiCache wraps an instrument session and remembers the last value
+written to each setting, eg. `SOURCE1:VOLTAGE:OFFSET 0.1`. Writing the
+same value again is not sent to the instrument. Queries of fixed
+information (*IDN?) are answered from the cache after the first time.
+Inside `with cache.batch():` consecutive writes are joined into a
+single `;`-separated message.
+
+Known state is forgotten when a command changes settings as a side
+effect: *RST, *RCL, APPLy, DATA (arbitrary waveforms) and CONFigure.
+CONFigure is always sent, also when it is the same as the last one: it
+resets the trigger settings too (eg. after a burst that failed with
+TRIG:SOUR EXT). Call invalidate() if the instrument may have been
+changed behind the back of the cache.
+"""
+import contextlib
+
+# Commands that change other settings as a side effect
+INVALIDATING = ('*RST', '*RCL', 'APPL', 'DATA')
+# Queries with answers that never change
+CACHED_QUERIES = ('*IDN?', '*OPT?')
+
+
+def _parse(part):
+    """
+    Split a single SCPI command in a normalised header and its argument.
+    """
+    part = part.strip()
+    header, _, argument = part.partition(' ')
+    return header.lstrip(':').upper(), argument.strip()
+
+
+class ScpiCache:
+    """
+    With enabled=False all commands are passed straight on, so the same
+    code runs with and without the cache. coalesce=False disables the
+    joining of writes in batch().
+    """
+
+    _own_attributes = (
+        'instr',
+        'enabled',
+        'coalesce',
+        'max_length',
+        'state',
+        'queries',
+        'counts',
+        '_batch',
+        '_batch_depth',
+        '_reconnects',
+    )
+
+    def __init__(self, instr, enabled=True, coalesce=True, max_length=240):
+        self.instr = instr
+        self.enabled = enabled
+        self.coalesce = coalesce
+        self.max_length = max_length
+        self.state = {}
+        self.queries = {}
+        self._batch = []
+        self._batch_depth = 0
+        self._reconnects = getattr(instr, 'reconnects', 0)
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.counts = {'sent': 0, 'suppressed': 0, 'coalesced': 0, 'cached_queries': 0}
+
+    def saved(self):
+        """
+        Number of round trips to the instrument saved by the cache.
+        """
+        return (
+            self.counts['suppressed']
+            + self.counts['coalesced']
+            + self.counts['cached_queries']
+        )
+
+    def summary(self):
+        msg = '{} sent, {} saved ({} suppressed, {} coalesced, {} cached queries)'
+        return msg.format(
+            self.counts['sent'],
+            self.saved(),
+            self.counts['suppressed'],
+            self.counts['coalesced'],
+            self.counts['cached_queries'],
+        )
+
+    def invalidate(self, queries=False):
+        """
+        Forget the known settings, with queries also the cached answers.
+        """
+        self.state = {}
+        if queries:
+            self.queries = {}
+
+    def _check_reconnect(self):
+        # A re-opened session may belong to another (or a power-cycled)
+        # instrument
+        reconnects = getattr(self.instr, 'reconnects', 0)
+        if reconnects != self._reconnects:
+            self._reconnects = reconnects
+            self.invalidate(queries=True)
+
+    def _is_redundant(self, cmd):
+        """
+        Update the known state with cmd and tell if it changes nothing.
+        """
+        parts = cmd.split(';')
+        for part in parts[1:]:
+            if not part.strip().startswith((':', '*')):
+                # A path relative to the previous command, give up
+                self.invalidate()
+                return False
+
+        redundant = True
+        for part in parts:
+            header, argument = _parse(part)
+            tokens = header.split(':')
+            if header.startswith('CONF'):
+                # Resets the other settings, including the trigger
+                self.state = {header: argument}
+                redundant = False
+            elif any(token.startswith(INVALIDATING) for token in tokens):
+                self.invalidate()
+                redundant = False
+            elif not argument or header.endswith('?'):
+                # Events (*TRG, INIT...) and queries always go through
+                redundant = False
+            elif self.state.get(header) != argument:
+                self.state[header] = argument
+                redundant = False
+        return redundant
+
+    def _send(self, cmd):
+        self.counts['sent'] += 1
+        return self.instr.write(cmd)
+
+    def flush(self):
+        """
+        Send the writes collected in a batch as a single message, split
+        if it would exceed max_length.
+        """
+        message = ''
+        for cmd in self._batch:
+            if not message:
+                message = cmd
+                continue
+            joined = message + ';:' + cmd.lstrip(':')
+            if len(joined) > self.max_length:
+                self._send(message)
+                message = cmd
+            else:
+                self.counts['coalesced'] += 1
+                message = joined
+        if message:
+            self._send(message)
+        self._batch = []
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Collect the writes in the block and send them as one message.
+        Queries and reads in the block send the collected writes first.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush()
+
+    def write(self, cmd):
+        if not self.enabled:
+            self.counts['sent'] += 1
+            return self.instr.write(cmd)
+        self._check_reconnect()
+        if self._is_redundant(cmd):
+            self.counts['suppressed'] += 1
+            return None
+        if self._batch_depth > 0 and self.coalesce:
+            self._batch.append(cmd)
+            return None
+        return self._send(cmd)
+
+    def query(self, cmd):
+        if not self.enabled:
+            self.counts['sent'] += 1
+            return self.instr.query(cmd)
+        self._check_reconnect()
+        self.flush()
+        key = cmd.strip().upper()
+        if key in CACHED_QUERIES:
+            if key in self.queries:
+                self.counts['cached_queries'] += 1
+                return self.queries[key]
+            self.counts['sent'] += 1
+            self.queries[key] = self.instr.query(cmd)
+            return self.queries[key]
+        self.counts['sent'] += 1
+        return self.instr.query(cmd)
+
+    def read(self):
+        self.flush()
+        return self.instr.read()
+
+    def write_ascii_values(self, cmd, values):
+        self.flush()
+        if self.enabled:
+            # Uploading data changes the waveform in use
+            self.invalidate()
+        self.counts['sent'] += 1
+        return self.instr.write_ascii_values(cmd, values)
+
+    def __getattr__(self, name):
+        return getattr(self.instr, name)
+
+    def __setattr__(self, name, value):
+        if name in self._own_attributes:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.instr, name, value)
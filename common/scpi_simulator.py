@@ -0,0 +1,562 @@
+"""
+Simulated instruments on local TCP ports.
+
+Each simulated instrument is a loopback SCPI server that implements the
+commands the exercises send to the Agilent 34401A DMM, the AWG (channel
+1 drives the circuit, falling edges on channel 2 trigger the DMM) and
+the power supply (SV, SI and L). Behind them is a model of the circuit:
+a device under test (DUT) in series with a shunt, the DMM measures the
+voltage over the shunt.
+
+Every message is delayed by `latency` and, for the serial instruments,
+by the time it takes to transfer it at the baud rate of the real
+instrument. DMM readings take as long as on the real instrument times
+time_scale (0 is instant).
+
+The scripts are pointed at the simulators through address overrides in
+the instrument registry, either in the same process:
+
+    start_simulators(dut='diode')
+
+or by running this module and setting INSTRUMENT_ADDRESSES as printed.
+pyvisa needs a backend with TCPIP SOCKET support, eg. pyvisa-py
+(PYVISA_LIBRARY=@py).
+"""
+import re
+import math
+import time
+import socket
+import argparse
+import threading
+import socketserver
+
+import numpy as np
+
+THERMAL_VOLTAGE = 0.02585  # V at room temperature
+# Level on AWG channel 2 that counts as a trigger edge for the DMM
+TRIGGER_LEVEL = 1.5
+
+
+def resistor(r=1000):
+    def current(v):
+        return v / r
+
+    return current
+
+
+def diode(i_s=1e-12, n=1.8):
+    def current(v):
+        # The exponent is limited, the circuit solver probes large voltages
+        return i_s * (math.exp(min(v / (n * THERMAL_VOLTAGE), 200)) - 1)
+
+    return current
+
+
+def led(i_s=1e-17, n=2.0):
+    """
+    A red LED, about 10mA at 1.8V.
+    """
+    return diode(i_s, n)
+
+
+DUTS = {
+    'R': resistor,
+    'diode': diode,
+    'LED': led,
+}
+
+
+class Circuit:
+    """
+    A source driving the DUT in series with a shunt. v_source is the DC
+    level of the source, v_ac the peak-peak amplitude of a sine on top of
+    it. current_limit (A) makes the source a constant current source
+    above that current.
+    """
+
+    def __init__(self, dut='diode', r_shunt=1000, noise=1e-6, seed=None, **dut_params):
+        if isinstance(dut, str):
+            dut = DUTS[dut](**dut_params)
+        self.dut = dut
+        self.r_shunt = r_shunt
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.v_source = 0.0
+        self.v_ac = 0.0
+        self.current_limit = None
+
+    def current(self, v_source):
+        # Bisection on the voltage over the DUT, where the DUT current
+        # equals the current through the shunt
+        low, high = sorted((0.0, v_source))
+        for _ in range(60):
+            v_dut = (low + high) / 2
+            if self.dut(v_dut) > (v_source - v_dut) / self.r_shunt:
+                high = v_dut
+            else:
+                low = v_dut
+        current = (v_source - (low + high) / 2) / self.r_shunt
+        if self.current_limit is not None:
+            current = min(current, self.current_limit)
+        return current
+
+    def shunt_voltage(self, ac=False):
+        """
+        DC voltage over the shunt, or with ac the RMS value of the AC part.
+        """
+        if ac:
+            half = self.v_ac / 2
+            high = self.current(self.v_source + half)
+            low = self.current(self.v_source - half)
+            value = abs(high - low) / 2 * self.r_shunt / math.sqrt(2)
+            return abs(value + self.rng.normal(0, self.noise))
+        value = self.current(self.v_source) * self.r_shunt
+        return value + self.rng.normal(0, self.noise)
+
+
+def _short(token):
+    """
+    Short form of a SCPI keyword: VOLTage -> VOLT, VOLatile -> VOL.
+    A numeric suffix is kept: SOURce2 -> SOUR2.
+    """
+    query = '?' if token.endswith('?') else ''
+    letters, number = re.fullmatch(r'(\D*)(\d*)', token.rstrip('?')).groups()
+    if letters.startswith('*'):
+        pass
+    elif len(letters) > 4 and letters[3] in 'AEIOU':
+        letters = letters[:3]
+    else:
+        letters = letters[:4]
+    return letters + number + query
+
+
+class SimulatedInstrument:
+    """
+    Base class of the simulated instruments. handle() is called with each
+    message received, responses are sent with reply(), possibly later
+    (eg. a reading that waits for a trigger). Settings without a special
+    meaning are stored and returned by the matching query.
+    """
+
+    idn = 'SIMULATED,INSTRUMENT,0,0'
+
+    def __init__(self, circuit, time_scale=1.0):
+        self.circuit = circuit
+        self.time_scale = time_scale
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        self.settings = {}
+
+    def normalise(self, header):
+        tokens = header.strip().lstrip(':').upper().split(':')
+        return ':'.join(_short(token) for token in tokens)
+
+    def handle(self, message, reply):
+        with self.lock:
+            for part in message.split(';'):
+                if not part.strip():
+                    continue
+                header, _, argument = part.strip().partition(' ')
+                header = self.normalise(header)
+                if header == '*IDN?':
+                    reply(self.idn)
+                elif header == '*RST':
+                    self.reset()
+                else:
+                    self.command(header, argument.strip(), reply)
+
+    def command(self, header, argument, reply):
+        if header.endswith('?'):
+            reply(self.settings.get(header[:-1], '0'))
+        else:
+            self.settings[header] = argument
+
+
+class Agilent34401aModel(SimulatedInstrument):
+    """
+    Voltage readings of the shunt, triggered immediately or by the AWG
+    (TRIG:SOUR EXT), with READ? or INIT and FETCH?.
+    """
+
+    idn = 'HEWLETT-PACKARD,34401A,0,11-5-2'
+
+    def reset(self):
+        super().reset()
+        self.function = 'DC'
+        self.nplc = 10.0
+        self.trigger_source = 'IMM'
+        self.trigger_count = 1
+        self.readings = []
+        self.armed = 0
+        self.pending = None  # reply() of a READ? waiting for triggers
+
+    def normalise(self, header):
+        header = super().normalise(header)
+        # SENSe is optional
+        if header.startswith('SENS:'):
+            header = header[5:]
+        return header
+
+    def reading_time(self):
+        if self.function == 'AC':
+            return 0.1 * self.time_scale
+        # Auto-zero doubles the integration time, 50Hz mains
+        return 2 * self.nplc / 50 * self.time_scale
+
+    def command(self, header, argument, reply):
+        if header.startswith('CONF:VOLT'):
+            self.function = 'AC' if header.endswith('AC') else 'DC'
+            self.settings[header] = argument
+        elif header.endswith(':NPLC'):
+            self.nplc = float(argument)
+        elif header.endswith(':NPLC?'):
+            reply('{:+.8E}'.format(self.nplc))
+        elif header == 'TRIG:SOUR':
+            self.trigger_source = _short(argument.upper())
+        elif header == 'TRIG:COUN':
+            self.trigger_count = int(float(argument))
+        elif header == 'INIT':
+            self._initiate(None)
+        elif header == 'READ?':
+            self._initiate(reply)
+        elif header == 'FETC?':
+            reply(','.join(self.readings))
+        else:
+            super().command(header, argument, reply)
+
+    def _initiate(self, reply):
+        self.readings = []
+        self.armed = self.trigger_count
+        self.pending = reply
+        if self.trigger_source == 'IMM':
+            while self.armed:
+                time.sleep(self.reading_time())
+                self._take_reading(delay=False)
+
+    def _take_reading(self, delay=True):
+        value = self.circuit.shunt_voltage(ac=self.function == 'AC')
+        self.readings.append('{:+.8E}'.format(value))
+        self.armed -= 1
+        if self.armed == 0 and self.pending is not None:
+            response = ','.join(self.readings)
+            if delay:
+                # Do not hold up the instrument that sent the trigger
+                timer = threading.Timer(self.reading_time(), self.pending, [response])
+                timer.start()
+            else:
+                self.pending(response)
+            self.pending = None
+
+    def trigger(self):
+        """
+        External trigger (from the AWG).
+        """
+        with self.lock:
+            if self.trigger_source == 'EXT' and self.armed:
+                self._take_reading()
+
+
+class AwgModel(SimulatedInstrument):
+    """
+    Two channels with DC, sine and arbitrary waveforms. Channel 1 drives
+    the circuit, a falling edge through TRIGGER_LEVEL on channel 2
+    triggers the DMM, also while arbitrary waveforms are played by *TRG.
+    """
+
+    idn = 'Agilent Technologies,33522A,0,2.03'
+
+    def __init__(self, circuit, dmm=None, time_scale=1.0):
+        self.dmm = dmm
+        super().__init__(circuit, time_scale)
+
+    def reset(self):
+        super().reset()
+        self.channels = {}
+        self.arbs = {}
+        for n in (1, 2):
+            self.channels[n] = {
+                'FUNC': 'SIN',
+                'VOLT': 0.1,
+                'OFFS': 0.0,
+                'FREQ': 1000.0,
+                'ARB': None,
+                'SRAT': 40e3,
+            }
+            self.arbs[n] = {}
+        self._update()
+
+    def normalise(self, header):
+        header = super().normalise(header)
+        if header.startswith('*'):
+            return header
+        tokens = header.split(':')
+        # SOURce is optional and the channel defaults to 1
+        if not tokens[0].startswith(('SOUR', 'TRIG', 'OUTP')):
+            tokens.insert(0, 'SOUR1')
+        elif not tokens[0][-1].isdigit():
+            tokens[0] += '1'
+        return ':'.join(tokens)
+
+    def _levels(self, n):
+        """
+        The output voltages of the arbitrary waveform of a channel.
+        """
+        channel = self.channels[n]
+        values = self.arbs[n].get(channel['ARB'])
+        if channel['FUNC'] != 'ARB' or values is None:
+            return None
+        return channel['OFFS'] + values * channel['VOLT'] / 2
+
+    def _level(self, n):
+        levels = self._levels(n)
+        if levels is not None:
+            # Waiting for a trigger at the first point
+            return levels[0]
+        return self.channels[n]['OFFS']
+
+    def _update(self):
+        channel = self.channels[1]
+        self.circuit.v_source = self._level(1)
+        self.circuit.v_ac = channel['VOLT'] if channel['FUNC'] == 'SIN' else 0.0
+
+    def _trigger_dmm(self):
+        if self.dmm is not None:
+            self.dmm.trigger()
+
+    def _play(self):
+        """
+        Play the arbitrary waveforms once in real time, in the background,
+        triggering the DMM on the falling edges of channel 2.
+        """
+        trigger = self._levels(2)
+        if trigger is None:
+            return
+        edges = np.flatnonzero(
+            (trigger[:-1] >= TRIGGER_LEVEL) & (trigger[1:] < TRIGGER_LEVEL)
+        )
+        thread = threading.Thread(
+            target=self._play_edges,
+            args=(self._levels(1), edges + 1, self.channels[2]['SRAT']),
+            daemon=True,
+        )
+        thread.start()
+
+    def _play_edges(self, staircase, edges, sample_rate):
+        start = time.perf_counter()
+        for edge in edges:
+            time.sleep(max(start + edge / sample_rate - time.perf_counter(), 0))
+            with self.lock:
+                if staircase is not None:
+                    self.circuit.v_source = staircase[min(edge, len(staircase) - 1)]
+                self._trigger_dmm()
+        if staircase is not None:
+            with self.lock:
+                self.circuit.v_source = staircase[-1]
+
+    def command(self, header, argument, reply):
+        before = self._level(2)
+        tokens = header.split(':')
+        if header == '*TRG':
+            self._play()
+            return
+        if not tokens[0].startswith('SOUR'):
+            super().command(header, argument, reply)
+            return
+        channel = self.channels[int(tokens[0][4:])]
+        arbs = self.arbs[int(tokens[0][4:])]
+        path = ':'.join(tokens[1:])
+        if path == 'FUNC':
+            channel['FUNC'] = _short(argument.upper())
+        elif path == 'APPL:DC':
+            channel['FUNC'] = 'DC'
+            channel['OFFS'] = float(argument.split(',')[-1])
+        elif path in ('VOLT', 'VOLT:OFFS', 'FREQ', 'FUNC:ARB:SRAT'):
+            channel[tokens[-1]] = float(argument)
+        elif path in ('VOLT?', 'VOLT:OFFS?', 'FREQ?', 'FUNC:ARB:SRAT?'):
+            reply('{:+.8E}'.format(channel[tokens[-1][:-1]]))
+        elif path == 'FUNC:ARB':
+            channel['ARB'] = argument
+        elif path == 'DATA:ARB':
+            name, *values = argument.split(',')
+            arbs[name.strip()] = np.array(values, dtype=float)
+        elif path == 'DATA:VOL:CLE':
+            arbs.clear()
+        else:
+            super().command(header, argument, reply)
+        self._update()
+        if before >= TRIGGER_LEVEL > self._level(2):
+            self._trigger_dmm()
+
+
+class PowerSupplyModel(SimulatedInstrument):
+    """
+    SV sets the voltage and SI the current limit. The status query L of
+    the real supply is not used by the exercises, so its format is not
+    known; here it returns the output voltage and current.
+    """
+
+    def reset(self):
+        super().reset()
+        self.circuit.v_source = 0.0
+        self.circuit.current_limit = 1.0
+
+    def command(self, header, argument, reply):
+        if header == 'SV':
+            self.circuit.v_source = float(argument)
+        elif header == 'SI':
+            self.circuit.current_limit = float(argument)
+        elif header == 'L':
+            current = self.circuit.current(self.circuit.v_source)
+            reply('V{:05.2f}A{:05.3f}'.format(self.circuit.v_source, current))
+        else:
+            super().command(header, argument, reply)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        send_lock = threading.Lock()
+
+        def reply(text):
+            data = (text + '\n').encode()
+            with send_lock:
+                time.sleep(server.transfer_time(len(data)))
+                self.request.sendall(data)
+
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = b''
+        while True:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                return
+            if hasattr(socket, 'TCP_QUICKACK'):
+                # Delayed ACKs would hold up the next small message of the
+                # client (Nagle) by up to 40ms, Linux resets this every time
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            # Messages end with \n or \r (the power supply)
+            *messages, buffer = re.split(b'[\r\n]', buffer + chunk)
+            for message in messages:
+                if not message.strip():
+                    continue
+                time.sleep(server.latency + server.transfer_time(len(message) + 1))
+                server.instrument.handle(message.decode(), reply)
+
+
+class SimulatorServer(socketserver.ThreadingTCPServer):
+    """
+    Serves one simulated instrument. baud is the emulated baud rate
+    (None for USB), bits the number of bits per character.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self, instrument, host='127.0.0.1', port=0, latency=0.0, baud=None, bits=10
+    ):
+        super().__init__((host, port), _Handler)
+        self.instrument = instrument
+        self.latency = latency
+        self.baud = baud
+        self.bits = bits
+
+    def transfer_time(self, size):
+        if self.baud is None:
+            return 0
+        return size * self.bits / self.baud
+
+    def resource(self):
+        host, port = self.server_address[:2]
+        return 'TCPIP::{}::{}::SOCKET'.format(host, port)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def start_simulators(
+    dut='diode',
+    host='127.0.0.1',
+    port=5025,
+    latency=0.0,
+    emulate_baud=True,
+    time_scale=1.0,
+    noise=1e-6,
+    register=True,
+    **dut_params
+):
+    """
+    Start the DMM, AWG and power supply simulators on port, port + 1 and
+    port + 2 (free ports if port is 0). The DMM and AWG share a circuit
+    with the given DUT and a 1kOhm shunt, the power supply drives an LED
+    with a 100Ohm shunt. With register, the instrument registry of this
+    process is set to use the simulators.
+    Returns the servers by the address the scripts use.
+    """
+    circuit = Circuit(dut, r_shunt=1000, noise=noise, **dut_params)
+    dmm = Agilent34401aModel(circuit, time_scale)
+    awg = AwgModel(circuit, dmm, time_scale)
+    psu = PowerSupplyModel(Circuit('LED', r_shunt=100, noise=noise), time_scale)
+
+    def baud(rate):
+        return rate if emulate_baud else None
+
+    def next_port(offset):
+        return port + offset if port else 0
+
+    servers = {
+        # 9600 baud, 8 data bits and 2 stop bits
+        'ASRL1::INSTR': SimulatorServer(
+            dmm, host, next_port(0), latency, baud(9600), bits=11
+        ),
+        'USB0': SimulatorServer(awg, host, next_port(1), latency),
+        'COM1': SimulatorServer(psu, host, next_port(2), latency, baud(2400)),
+    }
+    for name, server in servers.items():
+        server.start()
+        if register:
+            # Imported here, the simulators themselves do not need pyvisa
+            from common.instrument_registry import override_address
+
+            override_address(name, server.resource())
+    return servers
+
+
+def address_overrides(servers):
+    """
+    The value of INSTRUMENT_ADDRESSES for the servers.
+    """
+    return ';'.join(
+        '{}={}'.format(name, server.resource()) for name, server in servers.items()
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated SCPI instruments')
+    parser.add_argument('--dut', default='diode', help=', '.join(DUTS))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5025, help='First port')
+    parser.add_argument('--latency', type=float, default=0.0, help='s per message')
+    parser.add_argument('--no-baud', action='store_true', help='No serial delays')
+    parser.add_argument('--time-scale', type=float, default=1.0)
+    parser.add_argument('--noise', type=float, default=1e-6, help='V rms')
+    args = parser.parse_args()
+    servers = start_simulators(
+        args.dut,
+        args.host,
+        args.port,
+        args.latency,
+        not args.no_baud,
+        args.time_scale,
+        args.noise,
+        register=False,
+    )
+    print('INSTRUMENT_ADDRESSES="{}"'.format(address_overrides(servers)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,103 @@
+"""
+Wait for a reading to settle instead of sleeping for a fixed time.
+
+A SettleDetector repeatedly calls a read function until the last few
+readings agree within a tolerance, or until a straight line fitted to
+them shows no drift larger than the tolerance (noisy but settled
+signals). The time it took is recorded, so the actual settle times of
+a sweep can be inspected afterwards.
+"""
+import time
+
+import numpy as np
+
+
+class SettleDetector:
+    """
+    tolerance is absolute, relative is added as a fraction of the mean
+    reading. window is the number of readings that must agree, interval
+    is the pause between readings and timeout the longest time to wait.
+    """
+
+    def __init__(self, tolerance, relative=0.0, window=3, interval=0.0, timeout=5.0):
+        if window < 2:
+            raise ValueError('window must be at least 2 readings')
+        self.tolerance = tolerance
+        self.relative = relative
+        self.window = window
+        self.interval = interval
+        self.timeout = timeout
+        self.times = []
+        self.readings = []  # Number of readings per wait
+        self.timeouts = 0
+
+    def _limit(self, values):
+        return self.tolerance + self.relative * abs(np.mean(values))
+
+    def is_settled(self, times, values):
+        """
+        True if the readings agree within the tolerance, or if the drift
+        over the window of a linear fit is within the tolerance.
+        """
+        if len(values) < self.window:
+            return False
+        limit = self._limit(values)
+        if max(values) - min(values) <= limit:
+            return True
+        slope = np.polyfit(times, values, 1)[0]
+        return abs(slope * (times[-1] - times[0])) <= limit
+
+    def wait(self, read):
+        """
+        Call read() until the readings have settled or the timeout has
+        passed. Returns the last reading.
+        """
+        t_start = time.perf_counter()
+        times = []
+        values = []
+        count = 0
+        while True:
+            value = read()
+            count += 1
+            times.append(time.perf_counter() - t_start)
+            values.append(value)
+            times = times[-1 * self.window :]
+            values = values[-1 * self.window :]
+            if self.is_settled(times, values):
+                break
+            if times[-1] > self.timeout:
+                self.timeouts += 1
+                break
+            time.sleep(self.interval)
+        self.times.append(time.perf_counter() - t_start)
+        self.readings.append(count)
+        return value
+
+    def statistics(self):
+        """
+        Number of waits, timeouts and the mean, median and max settle time.
+        """
+        times = np.array(self.times)
+        if len(times) == 0:
+            return {'count': 0, 'timeouts': 0}
+        return {
+            'count': len(times),
+            'timeouts': self.timeouts,
+            'mean': times.mean(),
+            'median': np.median(times),
+            'max': times.max(),
+        }
+
+    def summary(self):
+        stats = self.statistics()
+        if stats['count'] == 0:
+            return 'No settle waits'
+        msg = '{} waits, {} timeouts, settle time mean {:.3f}s, median {:.3f}s, '
+        msg += 'max {:.3f}s'
+        return msg.format(
+            stats['count'],
+            stats['timeouts'],
+            stats['mean'],
+            stats['median'],
+            stats['max'],
+        )
@@ -0,0 +1,299 @@
+"""
+Opt-in tracing of instrument I/O.
+
+When enabled, every write/query/read of the instruments handed out by
+the instrument registry, every DAQ task wrapped in span() and
+(optionally) every time.sleep() is recorded with its duration and the
+number of bytes transferred. The trace can be exported as Chrome trace
+JSON (open in https://ui.perfetto.dev or chrome://tracing) and
+summarised per instrument and per command.
+
+Enable it before the instruments are opened, either with enable() or
+by setting the environment variable INSTRUMENT_TRACE to the name of the
+trace file, which is then written when the program exits. Set
+INSTRUMENT_TRACE_SLEEPS=1 as well to trace time.sleep(), so the fixed
+waits show up by file and line.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import contextlib
+
+import numpy as np
+
+# Upper limits of the histogram bins, seconds
+BINS = (1e-4, 1e-3, 1e-2, 1e-1, 1, 10, float('inf'))
+
+TRACER = None
+
+
+def _header(command):
+    """
+    The command without its arguments, used to group the statistics.
+    """
+    return command.strip().split(' ')[0]
+
+
+class Tracer:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, instrument, command, start, duration, bytes_out=0, bytes_in=0):
+        event = {
+            'instrument': instrument,
+            'command': command,
+            'start': start - self.t0,
+            'duration': duration,
+            'bytes_out': bytes_out,
+            'bytes_in': bytes_in,
+            'thread': threading.get_ident(),
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, instrument, command, bytes_out=0):
+        """
+        Record the duration of the block. The yielded dict may be used to
+        set the number of bytes received, span['bytes_in'].
+        """
+        info = {'bytes_in': 0}
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            duration = time.perf_counter() - start
+            self.record(
+                instrument, command, start, duration, bytes_out, info['bytes_in']
+            )
+
+    def export_chrome(self, path='trace.json'):
+        """
+        Write the trace as Chrome trace event JSON, one row (thread) per
+        instrument.
+        """
+        with self._lock:
+            events = list(self.events)
+        instruments = sorted({event['instrument'] for event in events})
+        rows = {name: n for n, name in enumerate(instruments)}
+        pid = os.getpid()
+        trace = []
+        for name, row in rows.items():
+            trace.append(
+                {
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': pid,
+                    'tid': row,
+                    'args': {'name': name},
+                }
+            )
+        for event in events:
+            trace.append(
+                {
+                    'name': _header(event['command']),
+                    'cat': event['instrument'],
+                    'ph': 'X',
+                    'pid': pid,
+                    'tid': rows[event['instrument']],
+                    'ts': 1e6 * event['start'],
+                    'dur': 1e6 * event['duration'],
+                    'args': {
+                        'command': event['command'],
+                        'bytes_out': event['bytes_out'],
+                        'bytes_in': event['bytes_in'],
+                        'thread': event['thread'],
+                    },
+                }
+            )
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, trace_file)
+        return path
+
+    def statistics(self, by_command=True):
+        """
+        Count, total, mean, 95th percentile and max duration and a
+        histogram (see BINS) per instrument, or per instrument and
+        command. Sorted by total time, largest first.
+        """
+        with self._lock:
+            events = list(self.events)
+        groups = {}
+        for event in events:
+            key = event['instrument']
+            if by_command:
+                key = (key, _header(event['command']))
+            groups.setdefault(key, []).append(event['duration'])
+
+        stats = []
+        for key, durations in groups.items():
+            durations = np.array(durations)
+            histogram = np.histogram(durations, bins=(0,) + BINS)[0]
+            stats.append(
+                {
+                    'key': key,
+                    'count': len(durations),
+                    'total': durations.sum(),
+                    'mean': durations.mean(),
+                    'p95': np.percentile(durations, 95),
+                    'max': durations.max(),
+                    'histogram': histogram.tolist(),
+                }
+            )
+        stats.sort(key=lambda stat: stat['total'], reverse=True)
+        return stats
+
+    def print_summary(self, by_command=True):
+        labels = ['<{:g}s'.format(limit) for limit in BINS[:-1]] + ['more']
+        header = '{:<45} {:>6} {:>9} {:>9} {:>9} {:>9}  histogram ({})'
+        print(
+            header.format(
+                'instrument / command',
+                'count',
+                'total',
+                'mean',
+                'p95',
+                'max',
+                ' '.join(labels),
+            )
+        )
+        msg = '{:<45} {:>6d} {:>8.3f}s {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms  {}'
+        for stat in self.statistics(by_command):
+            key = stat['key']
+            if by_command:
+                key = '{} {}'.format(*key)
+            print(
+                msg.format(
+                    key[:45],
+                    stat['count'],
+                    stat['total'],
+                    1e3 * stat['mean'],
+                    1e3 * stat['p95'],
+                    1e3 * stat['max'],
+                    ' '.join(str(count) for count in stat['histogram']),
+                )
+            )
+
+
+class TracedSession:
+    """
+    Records the I/O of an instrument session, attributes not defined
+    here are passed on to the session.
+    """
+
+    _own_attributes = ('session', 'name', 'tracer')
+
+    def __init__(self, session, name, tracer):
+        self.session = session
+        self.name = name
+        self.tracer = tracer
+
+    def write(self, cmd):
+        with self.tracer.span(self.name, cmd, len(cmd)):
+            return self.session.write(cmd)
+
+    def query(self, cmd):
+        with self.tracer.span(self.name, cmd, len(cmd)) as span:
+            response = self.session.query(cmd)
+            span['bytes_in'] = len(response)
+        return response
+
+    def read(self):
+        with self.tracer.span(self.name, 'read') as span:
+            response = self.session.read()
+            span['bytes_in'] = len(response)
+        return response
+
+    def write_ascii_values(self, cmd, values):
+        # Approximate size, pyvisa formats the values itself
+        size = len(cmd) + sum(len('{:f},'.format(value)) for value in values)
+        with self.tracer.span(self.name, cmd.strip(' ,'), size):
+            return self.session.write_ascii_values(cmd, values)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def __setattr__(self, name, value):
+        if name in self._own_attributes:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.session, name, value)
+
+
+_traced_sessions = {}
+_sleep = time.sleep
+
+
+def _traced_sleep(seconds):
+    # Name the wait after the code that called time.sleep()
+    frame = sys._getframe(1)
+    filename = os.path.basename(frame.f_code.co_filename)
+    location = '{}:{}'.format(filename, frame.f_lineno)
+    with TRACER.span('sleep', location):
+        _sleep(seconds)
+
+
+def traced(session, name):
+    """
+    The session wrapped in a TracedSession if tracing is enabled,
+    otherwise the session itself.
+    """
+    if TRACER is None:
+        return session
+    key = id(session)
+    if key not in _traced_sessions:
+        _traced_sessions[key] = TracedSession(session, name, TRACER)
+    return _traced_sessions[key]
+
+
+def span(instrument, command, bytes_out=0):
+    """
+    Tracer.span() if tracing is enabled, otherwise a no-op context.
+    """
+    if TRACER is None:
+        return contextlib.nullcontext({'bytes_in': 0})
+    return TRACER.span(instrument, command, bytes_out)
+
+
+def enable(path=None, sleeps=False):
+    """
+    Start tracing. With path, the trace is exported to that file and a
+    summary printed when the program exits. With sleeps, time.sleep()
+    is traced as well, by replacing it for the whole process (including
+    pyvisa and other threads) until disable().
+    """
+    global TRACER
+    if TRACER is None:
+        TRACER = Tracer()
+    if sleeps:
+        time.sleep = _traced_sleep
+    if path is not None:
+        atexit.register(_export_at_exit, path)
+    return TRACER
+
+
+def disable():
+    global TRACER
+    time.sleep = _sleep
+    TRACER = None
+    _traced_sessions.clear()
+
+
+def _export_at_exit(path):
+    if TRACER is None:
+        return
+    TRACER.export_chrome(path)
+    TRACER.print_summary()
+    print('Instrument trace written to {}'.format(path))
+
+
+if os.environ.get('INSTRUMENT_TRACE'):
+    enable(
+        os.environ['INSTRUMENT_TRACE'],
+        sleeps=os.environ.get('INSTRUMENT_TRACE_SLEEPS', '0') not in ('', '0'),
+    )